@@ -0,0 +1,74 @@
+# %% imports
+import os
+import sqlite3
+import time
+from gwfvis_db import Dimension, Location, Options, Value, Variable, WriterOptions, generate_gwfvis_db, read_gwfvis_db
+
+# %% configs
+# TODO modify the configs if needed
+db_path = 'output/benchmark.gwfvisdb'
+location_count = 2000
+time_size = 200
+
+# %% synthetic dataset
+dimension_time = Dimension(id=0, name='time', size=time_size)
+dimensions = [dimension_time]
+variable = Variable(id=0, name='synthetic', dimensions=dimensions)
+variables = [variable]
+locations = [
+    Location(id=i, geometry={'type': 'Point', 'coordinates': [i, i]})
+    for i in range(location_count)
+]
+values = [
+    Value(location=location, variable=variable, value=time * 0.5,
+          dimension_dict={dimension_time: time})
+    for time in range(time_size)
+    for location in locations
+]
+
+
+def benchmark(label: str, function, row_count: int):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f'{label}: {row_count} rows in {elapsed:.2f}s ({row_count / elapsed:,.0f} rows/s)')
+
+
+# %% write
+os.makedirs(os.path.dirname(db_path), exist_ok=True)
+options = Options(info=[], locations=locations,
+                  dimensions=dimensions, variables=variables, values=values)
+benchmark('write (default SQLite PRAGMAs)', lambda: generate_gwfvis_db(db_path, options, WriterOptions(
+    journal_mode=None, synchronous=None, page_size=None, cache_size=None)), len(values))
+benchmark('write (build PRAGMAs)', lambda: generate_gwfvis_db(
+    db_path, options), len(values))
+
+# %% query layouts ("all locations for a variable at a time step")
+layouts = [
+    ('no secondary index', WriterOptions(create_indexes=False)),
+    ('covering index', WriterOptions()),
+    ('WITHOUT ROWID', WriterOptions(without_rowid=True)),
+]
+for label, writer_options in layouts:
+    generate_gwfvis_db(db_path, options, writer_options)
+    db_connection = sqlite3.connect(db_path)
+    query_count = 50
+    start = time.perf_counter()
+    for i in range(query_count):
+        db_connection.execute('SELECT location, value FROM value WHERE variable = ? AND dimension_0 = ?',
+                              [variable.id, i * time_size // query_count]).fetchall()
+    elapsed = time.perf_counter() - start
+    db_connection.close()
+    print(f'query ({label}): {elapsed / query_count * 1000:.2f} ms/query, {os.path.getsize(db_path) / 1024 / 1024:.1f} MiB')
+
+# %% read (scaling in row count)
+for scale in [1, 2, 4]:
+    scaled_locations = locations[:location_count * scale // 4]
+    scaled_values = [
+        value for value in values if value.location.id < len(scaled_locations)]
+    generate_gwfvis_db(db_path, Options(info=[], locations=scaled_locations,
+                                        dimensions=dimensions, variables=variables, values=scaled_values))
+    benchmark(f'read ({len(scaled_locations)} locations)',
+              lambda: read_gwfvis_db(db_path), len(scaled_values))
+
+# %% finished
@@ -0,0 +1,212 @@
+# %% imports
+import os
+import shutil
+import sqlite3
+import tempfile
+import zlib
+from itertools import product
+from typing import Callable, Dict, Sequence, Tuple, Union
+import numpy as np
+
+# %% helpers
+VALUE_BACKENDS = ['table', 'sqlite_chunks', 'npy_directory']
+CHUNK_DTYPE = np.dtype('<f8')
+
+
+def get_chunk_shape(shape: Sequence[int], chunk_cells: int = 16384) -> Tuple[int, ...]:
+    """Halve the longest dimension axis until a chunk holds at most
+    `chunk_cells` cells, and the location axis (axis 0) only once the others
+    are down to one, so that a map of one step reads as few chunks as
+    possible."""
+    chunk_shape = list(map(lambda size: max(int(size), 1), shape))
+    while int(np.prod(chunk_shape)) > chunk_cells:
+        if max(chunk_shape[1:], default=1) > 1:
+            axis = 1 + int(np.argmax(chunk_shape[1:]))
+        elif chunk_shape[0] > 1:
+            axis = 0
+        else:
+            break
+        chunk_shape[axis] = -(-chunk_shape[axis] // 2)
+    return tuple(chunk_shape)
+
+
+def get_chunk_grid_shape(shape: Sequence[int], chunk_shape: Sequence[int]) -> Tuple[int, ...]:
+    return tuple(map(lambda item: max(-(-item[0] // item[1]), 1), zip(shape, chunk_shape)))
+
+
+def _get_chunk_slices(shape: Sequence[int], chunk_shape: Sequence[int], chunk_coordinates: Sequence[int]):
+    return tuple(map(lambda item: slice(item[2] * item[1], min((item[2] + 1) * item[1], item[0])),
+                     zip(shape, chunk_shape, chunk_coordinates)))
+
+
+def encode_chunk(array: np.ndarray) -> bytes:
+    return zlib.compress(np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<')).tobytes(), 1)
+
+
+def decode_chunk(data: bytes, shape: Sequence[int], dtype: np.dtype = CHUNK_DTYPE) -> np.ndarray:
+    return np.frombuffer(zlib.decompress(data), dtype=np.dtype(dtype).newbyteorder('<')).reshape(shape)
+
+
+# %% chunk stores
+class SQLiteChunkStore:
+    """Chunks as zlib compressed BLOBs in the `value_chunk` table."""
+
+    def __init__(self, db_connection: sqlite3.Connection):
+        self.db_connection = db_connection
+
+    def create(self):
+        self.db_connection.execute('''
+            CREATE TABLE IF NOT EXISTS value_chunk (
+                variable INTEGER NOT NULL,
+                chunk INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (variable, chunk)
+            )
+        ''')
+
+    def write_chunk(self, variable_id: int, chunk: int, array: np.ndarray):
+        self.db_connection.execute('INSERT OR REPLACE INTO value_chunk (variable, chunk, data) VALUES (?, ?, ?)', [
+            variable_id, chunk, encode_chunk(array)])
+
+    def read_chunk(self, variable_id: int, chunk: int, shape: Sequence[int], dtype: np.dtype = CHUNK_DTYPE) -> np.ndarray:
+        db_cursor = self.db_connection.cursor()
+        db_cursor.execute('SELECT data FROM value_chunk WHERE variable = ? AND chunk = ?', [
+            variable_id, chunk])
+        row = db_cursor.fetchone()
+        return None if row is None else decode_chunk(row[0], shape, dtype)
+
+    def delete_variable(self, variable_id: int):
+        self.db_connection.execute(
+            'DELETE FROM value_chunk WHERE variable = ?', [variable_id])
+
+
+class NpyDirectoryChunkStore:
+    """Chunks as `<variable>/<chunk>.npy` files under `directory`; they are
+    memory-mapped when read, so slicing only touches the cells asked for."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def create(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+
+    def _get_chunk_path(self, variable_id: int, chunk: int):
+        return os.path.join(self.directory, str(variable_id), f'{chunk}.npy')
+
+    def write_chunk(self, variable_id: int, chunk: int, array: np.ndarray):
+        os.makedirs(os.path.join(self.directory,
+                    str(variable_id)), exist_ok=True)
+        np.save(self._get_chunk_path(variable_id, chunk),
+                np.ascontiguousarray(array))
+
+    def read_chunk(self, variable_id: int, chunk: int, shape: Sequence[int], dtype: np.dtype = CHUNK_DTYPE) -> np.ndarray:
+        path = self._get_chunk_path(variable_id, chunk)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def delete_variable(self, variable_id: int):
+        shutil.rmtree(os.path.join(self.directory,
+                      str(variable_id)), ignore_errors=True)
+
+
+ChunkStore = Union[SQLiteChunkStore, NpyDirectoryChunkStore]
+
+
+# %% writing and reading
+class ChunkedArrayWriter:
+    """Collects the cells of every variable in a NaN-filled scratch array on
+    disk, since values may arrive in any order, and cuts them into chunks
+    once all values are in. Chunks without a single value are not stored."""
+
+    def __init__(self, location_ids: Sequence[int], scratch_directory: str = None):
+        self.location_ids = np.asarray(location_ids, dtype=np.int64)
+        self.location_order = np.argsort(self.location_ids)
+        self.sorted_location_ids = self.location_ids[self.location_order]
+        self.arrays: Dict[int, np.ndarray] = {}
+        self._scratch_directory = tempfile.TemporaryDirectory(
+            dir=scratch_directory)
+
+    def add_variable(self, variable_id: int, shape: Sequence[int]):
+        array = np.lib.format.open_memmap(os.path.join(self._scratch_directory.name, f'{variable_id}.npy'), mode='w+',
+                                          dtype=CHUNK_DTYPE, shape=(self.location_ids.size, *shape))
+        array[...] = np.nan
+        self.arrays[variable_id] = array
+
+    def get_location_positions(self, location_ids: Sequence[int]) -> np.ndarray:
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(
+            self.sorted_location_ids, location_ids), max(self.sorted_location_ids.size - 1, 0))
+        if self.sorted_location_ids.size == 0 or (self.sorted_location_ids[positions] != location_ids).any():
+            unknown_location_ids = np.setdiff1d(
+                location_ids, self.sorted_location_ids)
+            raise ValueError(
+                f'values of unknown locations {unknown_location_ids[:10].tolist()} cannot be stored as a chunked array')
+        return self.location_order[positions]
+
+    def write(self, variable_id: int, location_ids: Sequence[int], index: tuple, array: np.ndarray):
+        # `index` picks the dimension axes with ints and slices, `array` runs
+        # over the locations and the sliced axes
+        self.arrays[variable_id][(slice(None), *index)][self.get_location_positions(
+            location_ids)] = array
+
+    def write_cells(self, variable_id: int, location_ids: Sequence[int], dimension_indices: np.ndarray, values: np.ndarray):
+        self.arrays[variable_id][(self.get_location_positions(
+            location_ids), *np.asarray(dimension_indices, dtype=np.int64).T)] = values
+
+    def finish(self, store: ChunkStore, chunk_shapes: Dict[int, Sequence[int]], encoders: Dict[int, Callable[[np.ndarray], np.ndarray]] = None):
+        # `encoders` turn a variable's float chunks into the arrays stored
+        for variable_id, array in self.arrays.items():
+            chunk_shape = chunk_shapes[variable_id]
+            encoder = (encoders or {}).get(variable_id)
+            for chunk, chunk_coordinates in enumerate(product(*map(range, get_chunk_grid_shape(array.shape, chunk_shape)))):
+                chunk_array = array[_get_chunk_slices(
+                    array.shape, chunk_shape, chunk_coordinates)]
+                if not np.isnan(chunk_array).all():
+                    store.write_chunk(variable_id, chunk, chunk_array if encoder is None else encoder(
+                        chunk_array))
+
+    def close(self):
+        self.arrays.clear()
+        self._scratch_directory.cleanup()
+
+
+def read_chunked_array(store: ChunkStore, variable_id: int, shape: Sequence[int], chunk_shape: Sequence[int],
+                       axis_indices: Sequence[Sequence[int]], out: np.ndarray = None, dtype: np.dtype = CHUNK_DTYPE,
+                       decoder: Callable[[np.ndarray], np.ndarray] = None) -> np.ndarray:
+    """Gather the cells at the cross product of `axis_indices` (one index list
+    per axis, location positions first) into a new array, or into `out`;
+    missing chunks and indices past the stored shape read as NaN. `decoder`
+    turns the gathered cells of a `dtype` chunk back into floats."""
+    if out is None:
+        result = np.full(list(map(len, axis_indices)), np.nan)
+    else:
+        result = out
+        result[...] = np.nan
+    grid_shape = get_chunk_grid_shape(shape, chunk_shape)
+    # per axis: chunk coordinate -> (positions in the result, indices in the chunk)
+    axis_chunk_selections = []
+    for indices, size, chunk_size in zip(axis_indices, shape, chunk_shape):
+        indices = np.asarray(indices, dtype=np.int64)
+        positions = np.flatnonzero((indices >= 0) & (indices < size))
+        chunk_coordinates = indices[positions] // chunk_size
+        selections = {}
+        for chunk_coordinate in np.unique(chunk_coordinates).tolist():
+            selected = chunk_coordinates == chunk_coordinate
+            selections[chunk_coordinate] = (
+                positions[selected], indices[positions[selected]] - chunk_coordinate * chunk_size)
+        axis_chunk_selections.append(selections)
+    for chunk_coordinates in product(*map(lambda selections: sorted(selections.keys()), axis_chunk_selections)):
+        chunk_slices = _get_chunk_slices(shape, chunk_shape, chunk_coordinates)
+        chunk_array = store.read_chunk(variable_id, int(np.ravel_multi_index(chunk_coordinates, grid_shape)),
+                                       list(map(lambda chunk_slice: chunk_slice.stop - chunk_slice.start, chunk_slices)), dtype)
+        if chunk_array is None:
+            continue
+        selections = list(map(lambda item: item[0][item[1]], zip(
+            axis_chunk_selections, chunk_coordinates)))
+        cells = chunk_array[np.ix_(
+            *map(lambda selection: selection[1], selections))]
+        result[np.ix_(*map(lambda selection: selection[0], selections))
+               ] = cells if decoder is None else decoder(cells)
+    return result
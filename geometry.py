@@ -0,0 +1,332 @@
+# %% imports
+from array import array
+from itertools import accumulate
+import json
+import struct
+import sys
+import zlib
+from typing import Sequence, Tuple, Union
+import numpy as np
+
+# %% helpers
+GEOMETRY_ENCODINGS = ['json', 'indented_json', 'wkb', 'quantized']
+QUANTIZED_MAGIC = b'GVQ1'
+_QUANTIZED_ZLIB = 1
+_QUANTIZED_INT64 = 2
+_QUANTIZED_COMPRESS_THRESHOLD = 256
+
+# geometry type -> (WKB type code, nesting depth of its coordinates)
+_GEOMETRY_TYPES = {
+    'Point': (1, 0),
+    'LineString': (2, 1),
+    'Polygon': (3, 2),
+    'MultiPoint': (4, 1),
+    'MultiLineString': (5, 2),
+    'MultiPolygon': (6, 3),
+}
+_GEOMETRY_TYPE_NAMES = dict(
+    map(lambda item: (item[1][0], item[0]), _GEOMETRY_TYPES.items()))
+
+
+def _flatten_coordinates(coordinates, depth: int):
+    # returns the per-level part counts and the flat [x0, y0, x1, y1, ...] list
+    levels = [[] for _ in range(depth)]
+    flat = []
+
+    def visit(part, level):
+        if level == depth:
+            flat.append(part[0])
+            flat.append(part[1])
+            return
+        levels[level].append(len(part))
+        for child in part:
+            visit(child, level + 1)
+
+    visit(coordinates, 0)
+    return levels, flat
+
+
+def _nest_coordinates(levels, points: list, depth: int):
+    def build(level, counts_positions, point_position):
+        if level == depth:
+            return points[point_position[0]], 1
+        count = levels[level][counts_positions[level]]
+        counts_positions[level] += 1
+        parts = []
+        for _ in range(count):
+            part, _ = build(level + 1, counts_positions, point_position)
+            if level + 1 == depth:
+                point_position[0] += 1
+            parts.append(part)
+        return parts, count
+
+    coordinates, _ = build(0, [0] * depth, [0])
+    return coordinates
+
+
+def _encode_wkb(geometry: dict):
+    type_code, depth = _GEOMETRY_TYPES[geometry['type']]
+    coordinates = geometry['coordinates']
+    if type_code == 1:
+        return struct.pack('<BIdd', 1, 1, *coordinates[:2])
+    if type_code in [2, 3]:
+        levels, flat = _flatten_coordinates(coordinates, depth)
+        if type_code == 2:
+            return struct.pack(f'<BII{len(flat)}d', 1, 2, len(flat) // 2, *flat)
+        parts = [struct.pack('<BII', 1, 3, levels[0][0])]
+        start = 0
+        for count in levels[1]:
+            parts.append(struct.pack(
+                f'<I{count * 2}d', count, *flat[start:start + count * 2]))
+            start += count * 2
+        return b''.join(parts)
+    member_type = {4: 'Point', 5: 'LineString', 6: 'Polygon'}[type_code]
+    return struct.pack('<BII', 1, type_code, len(coordinates)) + b''.join(map(lambda member: _encode_wkb({
+        'type': member_type, 'coordinates': member}), coordinates))
+
+
+def _decode_wkb(data: bytes, offset: int = 0):
+    byte_order = '<' if data[offset] == 1 else '>'
+    type_code = struct.unpack_from(f'{byte_order}I', data, offset + 1)[0]
+    offset += 5
+
+    def read_points(offset):
+        count = struct.unpack_from(f'{byte_order}I', data, offset)[0]
+        flat = struct.unpack_from(f'{byte_order}{count * 2}d', data, offset + 4)
+        return list(map(list, zip(flat[0::2], flat[1::2]))), offset + 4 + count * 16
+
+    if type_code == 1:
+        return {'type': 'Point', 'coordinates': list(struct.unpack_from(f'{byte_order}dd', data, offset))}, offset + 16
+    if type_code == 2:
+        points, offset = read_points(offset)
+        return {'type': 'LineString', 'coordinates': points}, offset
+    count = struct.unpack_from(f'{byte_order}I', data, offset)[0]
+    offset += 4
+    if type_code == 3:
+        rings = []
+        for _ in range(count):
+            ring, offset = read_points(offset)
+            rings.append(ring)
+        return {'type': 'Polygon', 'coordinates': rings}, offset
+    members = []
+    for _ in range(count):
+        member, offset = _decode_wkb(data, offset)
+        members.append(member['coordinates'])
+    return {'type': _GEOMETRY_TYPE_NAMES[type_code], 'coordinates': members}, offset
+
+
+def _encode_quantized(geometry: dict, precision: int):
+    type_code, depth = _GEOMETRY_TYPES[geometry['type']]
+    levels, flat = _flatten_coordinates(geometry['coordinates'], depth)
+    scale = 10 ** precision
+    quantized = [round(value * scale) for value in flat]
+    # x and y are delta-encoded separately against the previous point
+    deltas = quantized[:2] + [quantized[i] - quantized[i - 2]
+                              for i in range(2, len(quantized))]
+    flags = 0
+    try:
+        coordinate_bytes = array('i', deltas)
+    except OverflowError:
+        coordinate_bytes = array('q', deltas)
+        flags |= _QUANTIZED_INT64
+    counts = array('I', [count for level in levels for count in level])
+    if sys.byteorder == 'big':
+        counts.byteswap()
+        coordinate_bytes.byteswap()
+    payload = counts.tobytes() + coordinate_bytes.tobytes()
+    if len(payload) >= _QUANTIZED_COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= _QUANTIZED_ZLIB
+    return QUANTIZED_MAGIC + struct.pack('<BBB', type_code, precision, flags) + payload
+
+
+def _decode_quantized(data: bytes):
+    header_size = len(QUANTIZED_MAGIC) + 3
+    type_code, precision, flags = struct.unpack_from(
+        '<BBB', data, len(QUANTIZED_MAGIC))
+    depth = _GEOMETRY_TYPES[_GEOMETRY_TYPE_NAMES[type_code]][1]
+    payload = data[header_size:]
+    if flags & _QUANTIZED_ZLIB:
+        payload = zlib.decompress(payload)
+    levels = []
+    offset = 0
+    level_length = 1
+    for _ in range(depth):
+        level = list(struct.unpack_from(f'<{level_length}I', payload, offset))
+        offset += level_length * 4
+        levels.append(level)
+        level_length = sum(level)
+    item_size = 8 if flags & _QUANTIZED_INT64 else 4
+    value_count = (len(payload) - offset) // item_size
+    deltas = struct.unpack_from(
+        f'<{value_count}{"q" if item_size == 8 else "i"}', payload, offset)
+    scale = 10 ** precision
+    points = list(map(lambda x, y: [x / scale, y / scale],
+                      accumulate(deltas[0::2]), accumulate(deltas[1::2])))
+    if depth == 0:
+        return {'type': 'Point', 'coordinates': points[0]}
+    return {'type': _GEOMETRY_TYPE_NAMES[type_code], 'coordinates': _nest_coordinates(levels, points, depth)}
+
+
+def _get_vertex_importance(points: np.ndarray, min_tolerance: float):
+    # Douglas-Peucker that splits every open span at once per pass, so the
+    # number of NumPy calls follows the recursion depth, not the vertex count.
+    # A vertex's importance is the smallest split distance on its way down the
+    # recursion; simplifying with tolerance t keeps exactly the vertices whose
+    # importance exceeds t, so one pass serves every level.
+    point_count = len(points)
+    coordinates = points[:, :2]
+    importance = np.zeros(point_count)
+    importance[[0, -1]] = np.inf
+    keep = importance > 0
+    while True:
+        kept_indices = np.flatnonzero(keep)
+        spans = np.searchsorted(kept_indices, np.arange(
+            point_count), side='right') - 1
+        spans = np.minimum(spans, len(kept_indices) - 2)
+        starts = coordinates[kept_indices[spans]]
+        directions = coordinates[kept_indices[spans + 1]] - starts
+        offsets = coordinates - starts
+        lengths = np.hypot(directions[:, 0], directions[:, 1])
+        cross = np.abs(directions[:, 0] * offsets[:, 1] -
+                       directions[:, 1] * offsets[:, 0])
+        # closed rings start and end on the same vertex
+        distances = np.where(lengths > 0, cross / np.where(lengths > 0, lengths, 1),
+                             np.hypot(offsets[:, 0], offsets[:, 1]))
+        distances[keep] = 0
+        span_maxima = np.maximum.reduceat(distances, kept_indices[:-1])
+        candidates = np.flatnonzero(
+            (distances > min_tolerance) & (distances == span_maxima[spans]))
+        if len(candidates) == 0:
+            return importance
+        # the first farthest vertex of each span
+        _, first = np.unique(spans[candidates], return_index=True)
+        candidates = candidates[first]
+        span_indices = spans[candidates]
+        importance[candidates] = np.minimum(distances[candidates], np.minimum(
+            importance[kept_indices[span_indices]], importance[kept_indices[span_indices + 1]]))
+        keep[candidates] = True
+
+
+def _simplify_part(part, depth: int, tolerances: Sequence[float], is_polygon: bool):
+    # depth 1 is a line or ring, depth 2 the rings of a polygon; returns one
+    # simplified part per tolerance
+    if depth == 1:
+        if len(part) <= (4 if is_polygon else 2):
+            return [part] * len(tolerances)
+        points = np.asarray(part, dtype=float)
+        importance = _get_vertex_importance(points, min(tolerances))
+        simplified_parts = []
+        for tolerance in tolerances:
+            keep = importance > tolerance
+            if is_polygon and np.count_nonzero(keep) < 4:
+                simplified_parts.append(None)
+            else:
+                simplified_parts.append(points[keep].tolist())
+        return simplified_parts
+    rings_by_tolerance = list(zip(*map(lambda ring: _simplify_part(
+        ring, 1, tolerances, is_polygon), part)))
+    if not is_polygon:
+        return list(map(list, rings_by_tolerance))
+    # a collapsed exterior keeps its vertices, collapsed holes are dropped
+    return list(map(lambda rings: [rings[0] if rings[0] is not None else part[0]] +
+                    [ring for ring in rings[1:] if ring is not None], rings_by_tolerance))
+
+
+def _simplify_geometry_levels(geometry: dict, tolerances: Sequence[float]):
+    if geometry is None or len(tolerances) == 0:
+        return [geometry] * len(tolerances)
+    geometry_type = geometry['type']
+    coordinates = geometry['coordinates']
+    if geometry_type in ['Point', 'MultiPoint']:
+        return [geometry] * len(tolerances)
+    if geometry_type in ['LineString', 'Polygon']:
+        coordinates_by_tolerance = _simplify_part(
+            coordinates, _GEOMETRY_TYPES[geometry_type][1], tolerances, geometry_type == 'Polygon')
+    else:
+        member_type = {'MultiLineString': 'LineString',
+                       'MultiPolygon': 'Polygon'}[geometry_type]
+        coordinates_by_tolerance = list(map(list, zip(*map(lambda member: _simplify_part(
+            member, _GEOMETRY_TYPES[member_type][1], tolerances, member_type == 'Polygon'), coordinates))))
+    return list(map(lambda coordinates: {'type': geometry_type, 'coordinates': coordinates}, coordinates_by_tolerance))
+
+
+# %% exported functions
+
+def encode_geometry(geometry: dict, encoding: str = 'json', precision: int = 6) -> Union[str, bytes]:
+    """Serialise a GeoJSON geometry for the `location` table.
+
+    `json` is minified GeoJSON text and `indented_json` the former
+    `indent=2` text. `wkb` is little-endian 2D Well-Known Binary. `quantized`
+    rounds coordinates to `precision` decimal places and stores them as
+    integer deltas behind a `GVQ1` header, zlib-compressed when that pays off.
+    Binary encodings drop any Z coordinate.
+    """
+    if geometry is None:
+        return None
+    if encoding == 'json':
+        return json.dumps(geometry, separators=(',', ':'))
+    if encoding == 'indented_json':
+        return json.dumps(geometry, indent=2)
+    if encoding == 'wkb':
+        return _encode_wkb(geometry)
+    if encoding == 'quantized':
+        return _encode_quantized(geometry, precision)
+    raise ValueError(
+        f'unknown geometry encoding "{encoding}", expected one of {GEOMETRY_ENCODINGS}')
+
+
+def decode_geometry(data: Union[str, bytes]) -> dict:
+    """Inverse of `encode_geometry`; the encoding is detected from the data."""
+    if data is None:
+        return None
+    if isinstance(data, str):
+        return json.loads(data)
+    data = bytes(data)
+    if data.startswith(QUANTIZED_MAGIC):
+        return _decode_quantized(data)
+    return _decode_wkb(data)[0]
+
+
+def simplify_geometry(geometry: dict, tolerance: Union[float, Sequence[float]]):
+    """Douglas-Peucker simplification of a GeoJSON geometry.
+
+    `tolerance` is in coordinate units; pass a sequence to get one geometry
+    per tolerance from a single pass. Line ends are always kept; polygon
+    rings keep at least four vertices and holes that would collapse are
+    dropped. Points pass through unchanged.
+    """
+    if not isinstance(tolerance, (int, float)):
+        return _simplify_geometry_levels(geometry, tolerance)
+    return _simplify_geometry_levels(geometry, [tolerance])[0]
+
+
+def get_bbox(geometry: dict) -> Tuple[float, float, float, float]:
+    """`(min_x, min_y, max_x, max_y)` of a geometry, or None if it is empty."""
+    if geometry is None:
+        return None
+    _, flat = _flatten_coordinates(
+        geometry['coordinates'], _GEOMETRY_TYPES[geometry['type']][1])
+    if len(flat) == 0:
+        return None
+    xs = flat[0::2]
+    ys = flat[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def count_vertices(geometry: dict) -> int:
+    if geometry is None:
+        return 0
+    depth = _GEOMETRY_TYPES[geometry['type']][1]
+
+    def count(part, level):
+        if level >= depth - 1:
+            return len(part) if depth > 0 else 1
+        return sum(map(lambda child: count(child, level + 1), part))
+
+    return count(geometry['coordinates'], 0)
+
+
+# %%
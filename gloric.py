@@ -1,16 +1,15 @@
 # %% imports
-from typing import Sequence
-import shapefile
-import netCDF4 as nc
+import numpy as np
 from gwfvis_db import (
     Dimension,
-    Location,
     Options,
-    Value,
     Variable,
+    VariableArray,
+    WriterOptions,
     generate_gwfvis_db,
     Info,
 )
+from shapefile_source import ShapefileSource
 
 # %% configs
 # TODO modify the configs if needed
@@ -44,10 +43,16 @@ variable_fields = [
     },
 ]
 bbox = [-110, 49, -105, 54]
+# simplified geometry levels in the shapefile's coordinate units (degrees)
+lod_tolerances = [0.0005, 0.002, 0.01]
 
 
 # %% getting ready
-reader = shapefile.Reader(shape_file_path)
+variable_field_names = list(map(lambda x: x["name"], variable_fields))
+# shapes outside the bbox are skipped on their .shp record headers alone
+source = ShapefileSource(
+    shape_file_path, id_field="OBJECTID", exclude_fields=variable_field_names, bbox=bbox
+)
 
 # %% info
 info = [
@@ -56,29 +61,8 @@ info = [
 ]
 
 # %% locations
-variable_field_names = list(map(lambda x: x["name"], variable_fields))
-fields = [field for field in reader.fields[1:] if field[0] not in variable_field_names]
-locations_variable_data: Sequence[dict] = []
-locations: Sequence[Location] = []
-for shape_record in reader.shapeRecords():
-    if (
-        shape_record.shape.bbox[0] < bbox[0]
-        or shape_record.shape.bbox[1] < bbox[1]
-        or shape_record.shape.bbox[2] > bbox[2]
-        or shape_record.shape.bbox[3] > bbox[3]
-    ):
-        continue
-    id = int(shape_record.record["OBJECTID"])
-    geometry = shape_record.shape.__geo_interface__
-    field_names = [field[0] for field in fields]
-    metadata = dict(zip(field_names, shape_record.record))
-    locations.append(Location(id=id, geometry=geometry, metadata=metadata))
-    locations_variable_data.append(
-        {
-            field: shape_record.record[field]
-            for field in variable_field_names
-        }
-    )
+# streamed into the writer, one shape at a time
+locations = source.iter_locations()
 
 # %% dimensions
 default_dimension = Dimension(id=0, name="-", size=1)
@@ -97,20 +81,22 @@ variables = [
 ]
 
 # %% values
-values: Sequence[Value] = []
-for i, location in enumerate(locations):
-    for variable in variables:
-        value = locations_variable_data[i][variable.name]
-        if value is not None:
-            values.append(
-                Value(
-                    location=location,
-                    variable=variable,
-                    value=float(value),
-                    dimension_dict={default_dimension: 0},
-                )
+def values_generator():
+    # a second, .dbf-only pass; empty fields get no value rows
+    for location_ids, columns in source.iter_record_columns(variable_field_names):
+        for variable in variables:
+            array = columns[variable.name]
+            has_value = ~np.isnan(array)
+            yield VariableArray(
+                variable=variable,
+                array=array[has_value],
+                location_ids=location_ids[has_value],
+                dimension_dict={default_dimension: 0},
             )
 
+
+values = values_generator()
+
 # %% main function
 generate_gwfvis_db(
     db_path,
@@ -121,6 +107,7 @@ generate_gwfvis_db(
         variables=variables,
         values=values,
     ),
+    WriterOptions(lod_tolerances=lod_tolerances, spatial_index=True),
 )
 
 # %% finished
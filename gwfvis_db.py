@@ -1,10 +1,19 @@
 
 # %% imports
-from dataclasses import dataclass
+import ast
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, replace
 import json
 import os
+import shutil
 import sqlite3
-from typing import Dict, Sequence
+import tempfile
+from itertools import chain
+from typing import Callable, Dict, Iterable, Iterator, Sequence, Tuple, Union
+import numpy as np
+from chunked_array import CHUNK_DTYPE, VALUE_BACKENDS, ChunkedArrayWriter, NpyDirectoryChunkStore, SQLiteChunkStore, get_chunk_shape, read_chunked_array
+from geometry import GEOMETRY_ENCODINGS, count_vertices, decode_geometry, encode_geometry, get_bbox, simplify_geometry
 
 # %% data structures
 
@@ -41,6 +50,27 @@ class Dimension:
         return id(self)
 
 
+@dataclass
+class VariableStorage:
+    """How the values of a variable are stored, packed as with the CF
+    `scale_factor` and `add_offset` attributes: a value is kept as
+    `(value - add_offset) / scale_factor` rounded to `dtype` (`float64`,
+    `float32`, `int8`, `int16` or `int32`) and read back as
+    `stored * scale_factor + add_offset`.
+
+    `fill_value` is the stored number marking a missing cell where NULL is
+    not available, i.e. in chunked arrays; it defaults to the lowest value of
+    an integer `dtype`, which values then cannot be packed to.
+    """
+    dtype: str = 'float64'
+    scale_factor: float = 1.0
+    add_offset: float = 0.0
+    fill_value: float = None
+
+    def __hash__(self):
+        return id(self)
+
+
 @dataclass
 class Variable:
     id: int
@@ -48,6 +78,7 @@ class Variable:
     dimensions: Sequence[Dimension]
     unit: str = None
     description: str = None
+    storage: VariableStorage = None
 
     def __hash__(self):
         return id(self)
@@ -64,13 +95,153 @@ class Value:
         return id(self)
 
 
+@dataclass
+class VariableArray:
+    """A whole N-D array of values for one variable.
+
+    One axis of `array` (`location_axis`) runs over `location_ids`, each other
+    axis runs over the matching entry of `dimensions`. Variable dimensions not
+    spanned by the array are pinned by `dimension_dict`. Masked and NaN cells
+    are written as NULL.
+    """
+    variable: Variable
+    array: np.ndarray
+    location_ids: Sequence[int]
+    dimensions: Sequence[Dimension] = None
+    location_axis: int = 0
+    dimension_dict: Dict[Dimension, int] = None
+
+    def __hash__(self):
+        return id(self)
+
+
+@dataclass
+class LocationIdMapping:
+    """How the ids of a source dataset line up with `Location` ids.
+
+    `source_indices[i]` is the position in the source dataset of
+    `location_ids[i]`; ids found on only one side are reported separately.
+    """
+    source_indices: np.ndarray
+    location_ids: np.ndarray
+    unmatched_location_ids: np.ndarray
+    unmatched_source_ids: np.ndarray
+
+    def __hash__(self):
+        return id(self)
+
+
+@dataclass
+class ValueStats:
+    """Summary of the values of one variable at one dimension slice.
+
+    `min`, `max` and `mean` are None when the slice has no non-null value.
+    `histogram` counts values in equal-width bins over `histogram_range`;
+    values outside the range fall into the first or last bin.
+    """
+    variable: Variable
+    dimension_dict: Dict[Dimension, int]
+    min: float
+    max: float
+    mean: float
+    count: int
+    null_count: int
+    histogram: Sequence[int] = None
+    histogram_range: Tuple[float, float] = None
+
+    def __hash__(self):
+        return id(self)
+
+
 @dataclass
 class Options:
     info: Sequence[Info]
     locations: Sequence[Location]
     dimensions: Sequence[Dimension]
     variables: Sequence[Variable]
-    values: Sequence[Value]
+    values: Iterable[Union[Value, VariableArray]]
+
+    def __hash__(self):
+        return id(self)
+
+
+@dataclass
+class WriterOptions:
+    """Build-time tuning for `generate_gwfvis_db`.
+
+    The PRAGMAs only apply while the database is being generated; the journal
+    mode is switched back to `DELETE` once the build has finished so the output
+    is a single self-contained file. Set a PRAGMA to `None` to keep SQLite's
+    default.
+
+    `create_indexes` adds a covering `(variable, dimension_*, location, value)`
+    index once all values have been inserted. `without_rowid` instead clusters
+    the value table on `(variable, dimension_*, location)`, which serves the
+    same queries without a separate index; it requires every variable to span
+    every dimension, since primary key columns of a `WITHOUT ROWID` table
+    cannot be NULL.
+
+    `geometry_encoding` selects how location geometries are stored, see
+    `geometry.encode_geometry`; readers detect the encoding per row.
+    `geometry_precision` is the number of decimal places kept by `quantized`.
+
+    `lod_tolerances` adds Douglas-Peucker simplified copies of every geometry
+    to `location_lod`, one level per ascending tolerance in coordinate units.
+    A level only stores the geometries it actually reduces.
+
+    `spatial_index` fills a `location_rtree` R*Tree with the bounding box of
+    every location for `GwfVisDB.query_locations_by_bbox`.
+
+    `value_stats` accumulates a `value_stats` row (min, max, mean, count and
+    null count) per variable and dimension slice while the values stream
+    in. Histograms need their range before the first value arrives, so they
+    are only kept for the variables named in `histogram_ranges`, with
+    `histogram_bins` bins each.
+
+    `pyramid_factors` adds coarser copies of every variable spanning the
+    `pyramid_dimension`, e.g. `[12, 120]` for yearly and decadal aggregates
+    of monthly steps. They are reduced with `pyramid_method` (`mean`, `sum`,
+    `min` or `max`) in the same pass that writes the values and stored in
+    `value_pyramid`, one level per factor; a level holds one grid of coarse
+    steps by locations per variable slice in memory until the end.
+
+    `value_backend` stores every variable as a chunked N-D array (locations
+    by the variable's dimensions) instead of one `value` row per cell:
+    `sqlite_chunks` as zlib compressed BLOBs in `value_chunk`, `npy_directory`
+    as memory-mapped `.npy` files in a `<file name>.chunks` directory next to
+    the database. Chunks hold up to `chunk_cells` float64 cells (more cells
+    of a variable packed to a smaller `VariableStorage.dtype`); `value_array`
+    describes each array and `GwfVisDB` reads either layout transparently.
+    A chunked array cannot tell a NULL (NaN or masked) cell from a cell that
+    was never written, so NULL cells are dropped there: `iter_values`,
+    `to_options` and `read_gwfvis_db` return them as `None` values for the
+    `table` backend only.
+
+    `value_series` also stores every series along `series_dimension` (one
+    location of a variable with its other dimensions fixed) as a single
+    float32 BLOB row in `value_series`, for `GwfVisDB.get_series`.
+    """
+    chunk_size: int = 100000
+    journal_mode: str = 'OFF'
+    synchronous: str = 'OFF'
+    page_size: int = 65536
+    cache_size: int = -262144
+    create_indexes: bool = True
+    without_rowid: bool = False
+    geometry_encoding: str = 'json'
+    geometry_precision: int = 6
+    lod_tolerances: Sequence[float] = None
+    spatial_index: bool = False
+    value_stats: bool = True
+    histogram_bins: int = 0
+    histogram_ranges: Dict[str, Tuple[float, float]] = None
+    pyramid_factors: Sequence[int] = None
+    pyramid_dimension: str = 'time'
+    pyramid_method: str = 'mean'
+    value_backend: str = 'table'
+    chunk_cells: int = 16384
+    value_series: bool = False
+    series_dimension: str = 'time'
 
     def __hash__(self):
         return id(self)
@@ -92,6 +263,27 @@ def _create_database(path: str):
     return _open_database(path)
 
 
+def _apply_build_pragmas(db_connection: sqlite3.Connection, writer_options: WriterOptions):
+    # page_size has to be set before the first table is created to take effect
+    if writer_options.page_size is not None:
+        _execute_sql(db_connection,
+                     f'PRAGMA page_size = {int(writer_options.page_size)}')
+    if writer_options.cache_size is not None:
+        _execute_sql(db_connection,
+                     f'PRAGMA cache_size = {int(writer_options.cache_size)}')
+    if writer_options.journal_mode is not None:
+        _execute_sql(db_connection,
+                     f'PRAGMA journal_mode = {writer_options.journal_mode}')
+    if writer_options.synchronous is not None:
+        _execute_sql(db_connection,
+                     f'PRAGMA synchronous = {writer_options.synchronous}')
+
+
+def _restore_pragmas(db_connection: sqlite3.Connection, writer_options: WriterOptions):
+    if writer_options.journal_mode is not None:
+        _execute_sql(db_connection, 'PRAGMA journal_mode = DELETE')
+
+
 def _execute_sql(db_connection: sqlite3.Connection, sql: str, params: Sequence = None):
     db_cursor = db_connection.cursor()
     if params is None:
@@ -122,6 +314,38 @@ def _create_location_table(db_connection: sqlite3.Connection):
     _execute_sql(db_connection, sql)
 
 
+def _create_location_lod_tables(db_connection: sqlite3.Connection):
+    sql = '''
+        CREATE TABLE location_lod_level (
+            level INTEGER PRIMARY KEY,
+            tolerance FLOAT NOT NULL
+        )
+    '''
+    _execute_sql(db_connection, sql)
+    sql = '''
+        CREATE TABLE location_lod (
+            level INTEGER NOT NULL,
+            location INTEGER NOT NULL,
+            geometry TEXT,
+            FOREIGN KEY (level) REFERENCES location_lod_level (level),
+            FOREIGN KEY (location) REFERENCES location (id),
+            PRIMARY KEY (level, location)
+        )
+    '''
+    _execute_sql(db_connection, sql)
+
+
+def _create_location_rtree_table(db_connection: sqlite3.Connection):
+    sql = '''
+        CREATE VIRTUAL TABLE location_rtree USING rtree (
+            id,
+            min_x, max_x,
+            min_y, max_y
+        )
+    '''
+    _execute_sql(db_connection, sql)
+
+
 def _create_dimension_table(db_connection: sqlite3.Connection):
     sql = '''
         CREATE TABLE dimension (
@@ -147,6 +371,21 @@ def _create_variable_table(db_connection: sqlite3.Connection):
     _execute_sql(db_connection, sql)
 
 
+def _create_variable_storage_table(db_connection: sqlite3.Connection):
+    # only created once a variable has its own storage, also by add_variable
+    sql = '''
+        CREATE TABLE IF NOT EXISTS variable_storage (
+            variable INTEGER PRIMARY KEY,
+            dtype VARCHAR NOT NULL,
+            scale_factor FLOAT NOT NULL,
+            add_offset FLOAT NOT NULL,
+            fill_value FLOAT,
+            FOREIGN KEY (variable) REFERENCES variable (id)
+        )
+    '''
+    _execute_sql(db_connection, sql)
+
+
 def _create_variable_dimension_table(db_connection: sqlite3.Connection):
     sql = '''
         CREATE TABLE variable_dimension (
@@ -160,29 +399,173 @@ def _create_variable_dimension_table(db_connection: sqlite3.Connection):
     _execute_sql(db_connection, sql)
 
 
-def _create_value_table(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
+def _create_value_table(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension], without_rowid: bool = False):
     dimension_column_names = list(
         map(lambda dimension: f'dimension_{dimension.id}', dimensions))
+    if without_rowid:
+        # the clustered key doubles as the index for "all locations of a
+        # variable at a given dimension slice" queries
+        primary_key_column_names = [
+            'variable', *dimension_column_names, 'location']
+    else:
+        primary_key_column_names = [
+            'location', 'variable', *dimension_column_names]
     sql = f'''
         CREATE TABLE value (
             location INTEGER NOT NULL,
             variable INTEGER NOT NULL,
-            {f' INTEGER, {NEW_LINE_CHARACTER}'.join(dimension_column_names)}{', ' if dimension_column_names is not None else ''}
+            {''.join(map(lambda name: f'{name} INTEGER, {NEW_LINE_CHARACTER}', dimension_column_names))}
             value FLOAT,
             FOREIGN KEY (variable) REFERENCES variable (id),
-            PRIMARY KEY (location, variable{', ' if dimension_column_names is not None else ''}{', '.join(dimension_column_names)})
+            PRIMARY KEY ({', '.join(primary_key_column_names)})
+        ){' WITHOUT ROWID' if without_rowid else ''}
+    '''
+    _execute_sql(db_connection, sql)
+
+
+def _create_value_indexes(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
+    dimension_column_names = list(
+        map(lambda dimension: f'dimension_{dimension.id}', dimensions))
+    sql = f'''
+        CREATE INDEX value_variable_dimension_location ON value (
+            variable, {''.join(map(lambda name: f'{name}, ', dimension_column_names))}location, value
+        )
+    '''
+    _execute_sql(db_connection, sql)
+
+
+def _create_value_stats_table(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
+    dimension_column_names = list(
+        map(lambda dimension: f'dimension_{dimension.id}', dimensions))
+    sql = f'''
+        CREATE TABLE value_stats (
+            variable INTEGER NOT NULL,
+            {''.join(map(lambda name: f'{name} INTEGER, {NEW_LINE_CHARACTER}', dimension_column_names))}
+            min FLOAT,
+            max FLOAT,
+            mean FLOAT,
+            count INTEGER NOT NULL,
+            null_count INTEGER NOT NULL,
+            histogram_min FLOAT,
+            histogram_max FLOAT,
+            histogram TEXT,
+            FOREIGN KEY (variable) REFERENCES variable (id)
+        )
+    '''
+    _execute_sql(db_connection, sql)
+    _execute_sql(db_connection,
+                 'CREATE INDEX value_stats_variable ON value_stats (variable)')
+
+
+def _create_value_pyramid_tables(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
+    sql = '''
+        CREATE TABLE pyramid_level (
+            level INTEGER PRIMARY KEY,
+            dimension INTEGER NOT NULL,
+            factor INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            method VARCHAR NOT NULL,
+            FOREIGN KEY (dimension) REFERENCES dimension (id)
+        )
+    '''
+    _execute_sql(db_connection, sql)
+    dimension_column_names = list(
+        map(lambda dimension: f'dimension_{dimension.id}', dimensions))
+    sql = f'''
+        CREATE TABLE value_pyramid (
+            level INTEGER NOT NULL,
+            location INTEGER NOT NULL,
+            variable INTEGER NOT NULL,
+            {''.join(map(lambda name: f'{name} INTEGER, {NEW_LINE_CHARACTER}', dimension_column_names))}
+            value FLOAT,
+            FOREIGN KEY (level) REFERENCES pyramid_level (level),
+            FOREIGN KEY (variable) REFERENCES variable (id)
+        )
+    '''
+    _execute_sql(db_connection, sql)
+
+
+def _create_value_pyramid_indexes(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
+    # ordered for time series: one location of a variable across coarse steps
+    dimension_column_names = list(
+        map(lambda dimension: f'dimension_{dimension.id}', dimensions))
+    sql = f'''
+        CREATE INDEX value_pyramid_level_variable_location ON value_pyramid (
+            level, variable, location, {''.join(map(lambda name: f'{name}, ', dimension_column_names))}value
+        )
+    '''
+    _execute_sql(db_connection, sql)
+
+
+def _create_value_series_tables(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
+    sql = '''
+        CREATE TABLE series_dimension (
+            dimension INTEGER NOT NULL,
+            FOREIGN KEY (dimension) REFERENCES dimension (id)
+        )
+    '''
+    _execute_sql(db_connection, sql)
+    # the column of the series dimension itself stays NULL
+    dimension_column_names = list(
+        map(lambda dimension: f'dimension_{dimension.id}', dimensions))
+    sql = f'''
+        CREATE TABLE value_series (
+            location INTEGER NOT NULL,
+            variable INTEGER NOT NULL,
+            {''.join(map(lambda name: f'{name} INTEGER, {NEW_LINE_CHARACTER}', dimension_column_names))}
+            series BLOB NOT NULL,
+            FOREIGN KEY (variable) REFERENCES variable (id)
+        )
+    '''
+    _execute_sql(db_connection, sql)
+
+
+def _create_value_series_indexes(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
+    dimension_column_names = list(
+        map(lambda dimension: f'dimension_{dimension.id}', dimensions))
+    sql = f'''
+        CREATE INDEX value_series_variable_location ON value_series (
+            variable, location{''.join(map(lambda name: f', {name}', dimension_column_names))}
+        )
+    '''
+    _execute_sql(db_connection, sql)
+
+
+def _create_value_array_table(db_connection: sqlite3.Connection):
+    sql = '''
+        CREATE TABLE value_array (
+            variable INTEGER PRIMARY KEY,
+            backend VARCHAR NOT NULL,
+            shape TEXT NOT NULL,
+            chunk_shape TEXT NOT NULL,
+            location_ids BLOB NOT NULL,
+            path VARCHAR,
+            FOREIGN KEY (variable) REFERENCES variable (id)
         )
     '''
     _execute_sql(db_connection, sql)
 
 
-def _create_tables(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
+def _create_tables(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension], writer_options: WriterOptions):
     _create_info_table(db_connection)
     _create_location_table(db_connection)
+    if writer_options.lod_tolerances:
+        _create_location_lod_tables(db_connection)
+    if writer_options.spatial_index:
+        _create_location_rtree_table(db_connection)
     _create_dimension_table(db_connection)
     _create_variable_table(db_connection)
     _create_variable_dimension_table(db_connection)
-    _create_value_table(db_connection, dimensions)
+    _create_value_table(db_connection, dimensions,
+                        writer_options.without_rowid)
+    if writer_options.value_stats:
+        _create_value_stats_table(db_connection, dimensions)
+    if writer_options.pyramid_factors:
+        _create_value_pyramid_tables(db_connection, dimensions)
+    if writer_options.value_backend != 'table':
+        _create_value_array_table(db_connection)
+    if writer_options.value_series:
+        _create_value_series_tables(db_connection, dimensions)
 
 
 def _fill_info_table(db_connection: sqlite3.Connection, info: Sequence[Info]):
@@ -193,13 +576,69 @@ def _fill_info_table(db_connection: sqlite3.Connection, info: Sequence[Info]):
         _execute_sql(db_connection, sql, [inf.key, inf.value, inf.label])
 
 
-def _fill_location_table(db_connection: sqlite3.Connection, locations: Sequence[Location]):
+def _fill_location_table(db_connection: sqlite3.Connection, locations: Sequence[Location], or_replace: bool = False,
+                         geometry_encoding: str = 'json', geometry_precision: int = 6, lod_tolerances: Sequence[float] = None,
+                         spatial_index: bool = False, batch_size: int = 10000):
     sql = f'''
-        INSERT INTO location (id, geometry, metadata) values (?, ?, ?)
+        INSERT{' OR REPLACE' if or_replace else ''} INTO location (id, geometry, metadata) values (?, ?, ?)
     '''
+    rtree_sql = f'''
+        INSERT{' OR REPLACE' if or_replace else ''} INTO location_rtree (id, min_x, max_x, min_y, max_y) values (?, ?, ?, ?, ?)
+    '''
+    lod_sql = f'''
+        INSERT{' OR REPLACE' if or_replace else ''} INTO location_lod (level, location, geometry) values (?, ?, ?)
+    '''
+    lod_tolerances = lod_tolerances or []
+    # rows are collected and written with executemany, a batch at a time so
+    # that streamed locations are not all held in memory
+    rows = []
+    rtree_rows = []
+    lod_rows = []
+
+    def flush():
+        # the R*Tree and LOD tables only exist when asked for
+        db_cursor = db_connection.cursor()
+        if len(rows) > 0:
+            db_cursor.executemany(sql, rows)
+        if len(rtree_rows) > 0:
+            db_cursor.executemany(rtree_sql, rtree_rows)
+        if or_replace and len(lod_tolerances) > 0 and len(rows) > 0:
+            db_cursor.executemany('DELETE FROM location_lod WHERE location = ?', list(
+                map(lambda row: row[:1], rows)))
+        if len(lod_rows) > 0:
+            db_cursor.executemany(lod_sql, lod_rows)
+        rows.clear()
+        rtree_rows.clear()
+        lod_rows.clear()
+
     for location in locations:
-        _execute_sql(db_connection, sql, [
-                     location.id, json.dumps(location.geometry, indent=2), json.dumps(location.metadata, indent=2)])
+        rows.append((location.id, encode_geometry(location.geometry, geometry_encoding, geometry_precision),
+                     json.dumps(location.metadata, separators=(',', ':'))))
+        if spatial_index:
+            bbox = get_bbox(location.geometry)
+            if bbox is not None:
+                rtree_rows.append(
+                    (location.id, bbox[0], bbox[2], bbox[1], bbox[3]))
+        if len(lod_tolerances) > 0:
+            vertex_count = count_vertices(location.geometry)
+            simplified_geometries = simplify_geometry(
+                location.geometry, lod_tolerances)
+            for level, simplified_geometry in enumerate(simplified_geometries):
+                if count_vertices(simplified_geometry) >= vertex_count:
+                    continue
+                lod_rows.append((level, location.id, encode_geometry(
+                    simplified_geometry, geometry_encoding, geometry_precision)))
+        if len(rows) >= batch_size:
+            flush()
+    flush()
+
+
+def _fill_location_lod_level_table(db_connection: sqlite3.Connection, lod_tolerances: Sequence[float]):
+    sql = '''
+        INSERT INTO location_lod_level (level, tolerance) values (?, ?)
+    '''
+    for level, tolerance in enumerate(lod_tolerances):
+        _execute_sql(db_connection, sql, [level, tolerance])
 
 
 def _fill_dimension_table(db_connection: sqlite3.Connection, dimensions: Sequence[Dimension]):
@@ -211,15 +650,25 @@ def _fill_dimension_table(db_connection: sqlite3.Connection, dimensions: Sequenc
                      dimension.id, dimension.name, dimension.size, dimension.description, json.dumps(dimension.value_labels)])
 
 
-def _fill_variable_table(db_connection: sqlite3.Connection, variables: Sequence[Variable]):
+def _fill_variable_table(db_connection: sqlite3.Connection, variables: Sequence[Variable], or_replace: bool = False):
     sql = f'''
-        INSERT INTO variable (id, name, unit, description) values (?, ?, ?, ?)
+        INSERT{' OR REPLACE' if or_replace else ''} INTO variable (id, name, unit, description) values (?, ?, ?, ?)
     '''
     for variable in variables:
         _execute_sql(db_connection, sql, [
                      variable.id, variable.name, variable.unit, variable.description])
 
 
+def _fill_variable_storage_table(db_connection: sqlite3.Connection, variables: Sequence[Variable]):
+    sql = '''
+        INSERT INTO variable_storage (variable, dtype, scale_factor, add_offset, fill_value) values (?, ?, ?, ?, ?)
+    '''
+    for variable in filter(lambda variable: variable.storage is not None, variables):
+        storage = variable.storage
+        _execute_sql(db_connection, sql, [
+                     variable.id, storage.dtype, storage.scale_factor, storage.add_offset, storage.fill_value])
+
+
 def _fill_variable_dimension_table(db_connection: sqlite3.Connection, variables: Sequence[Variable]):
     sql = f'''
         INSERT INTO variable_dimension (variable, dimension) values (?, ?)
@@ -230,33 +679,991 @@ def _fill_variable_dimension_table(db_connection: sqlite3.Connection, variables:
                 _execute_sql(db_connection, sql, [variable.id, dimension.id])
 
 
-def _fill_value_table(db_connection: sqlite3.Connection, values: Sequence[Value]):
-    for value in values:
-        dimensions = list(value.dimension_dict.keys())
-        dimension_column_names = list(
-            map(lambda dimension: f'dimension_{dimension.id}', dimensions))
+def _get_value_insert_sql(dimension_ids: Tuple[int, ...]):
+    dimension_column_names = list(
+        map(lambda dimension_id: f'dimension_{dimension_id}', dimension_ids))
+    return f'''
+        INSERT INTO value (
+            location,
+            variable,
+            {''.join(map(lambda name: f'{name}, {NEW_LINE_CHARACTER}', dimension_column_names))}
+            value
+        ) values (?, ?, {''.join(map(lambda name: '?, ', dimension_column_names))}?)
+    '''
+
+
+def _get_value_delete_sql(dimension_ids: Tuple[int, ...]):
+    return f'''
+        DELETE FROM value WHERE location = ? AND variable = ?{''.join(map(lambda dimension_id: f' AND dimension_{dimension_id} = ?', dimension_ids))}
+    '''
+
+
+def _write_value_rows(db_connection: sqlite3.Connection, pending_rows: Dict[Tuple[int, ...], list], or_replace: bool = False):
+    db_cursor = db_connection.cursor()
+    for dimension_ids, rows in pending_rows.items():
+        if len(rows) > 0:
+            if or_replace:
+                # INSERT OR REPLACE would not match rows whose unused
+                # dimension columns are NULL, so the old rows are deleted
+                db_cursor.executemany(_get_value_delete_sql(
+                    dimension_ids), map(lambda row: row[:-1], rows))
+            db_cursor.executemany(_get_value_insert_sql(dimension_ids), rows)
+    pending_rows.clear()
+
+
+def _flush_value_rows(db_connection: sqlite3.Connection, pending_rows: Dict[Tuple[int, ...], list], commit: bool = True, or_replace: bool = False):
+    _write_value_rows(db_connection, pending_rows, or_replace)
+    if commit:
+        db_connection.commit()
+
+
+def _validate_value_dimensions(value: Value, dimension_dict: Dict[Dimension, int], dimension_ids: Tuple[int, ...], validated_signatures: set):
+    signature = (value.variable.id, dimension_ids)
+    if signature not in validated_signatures:
+        expected_dimension_ids = set(
+            map(lambda dimension: dimension.id, value.variable.dimensions or []))
+        if len(dimension_ids) != len(expected_dimension_ids) or set(dimension_ids) != expected_dimension_ids:
+            raise ValueError(
+                f'value of variable "{value.variable.name}" at location {value.location.id} has dimensions {list(dimension_ids)}, expected {sorted(expected_dimension_ids)}')
+        validated_signatures.add(signature)
+    for dimension, index in dimension_dict.items():
+        if index is None or index < 0 or index >= dimension.size:
+            raise ValueError(
+                f'value of variable "{value.variable.name}" at location {value.location.id} has index {index} out of range for dimension "{dimension.name}" of size {dimension.size}')
+
+
+def _validate_variable_array(variable_array: VariableArray, array: np.ndarray):
+    variable = variable_array.variable
+    dimensions = list(variable_array.dimensions or [])
+    fixed_dimension_dict = variable_array.dimension_dict or {}
+    if array.ndim != len(dimensions) + 1:
+        raise ValueError(
+            f'array of variable "{variable.name}" has {array.ndim} axes, expected {len(dimensions) + 1} (location + {len(dimensions)} dimensions)')
+    if array.shape[0] != len(variable_array.location_ids):
+        raise ValueError(
+            f'array of variable "{variable.name}" has {array.shape[0]} cells along the location axis but {len(variable_array.location_ids)} location ids')
+    dimension_ids = list(map(lambda dimension: dimension.id,
+                         dimensions + list(fixed_dimension_dict.keys())))
+    expected_dimension_ids = set(
+        map(lambda dimension: dimension.id, variable.dimensions or []))
+    if len(dimension_ids) != len(expected_dimension_ids) or set(dimension_ids) != expected_dimension_ids:
+        raise ValueError(
+            f'array of variable "{variable.name}" has dimensions {dimension_ids}, expected {sorted(expected_dimension_ids)}')
+    for dimension, axis_size in zip(dimensions, array.shape[1:]):
+        if axis_size > dimension.size:
+            raise ValueError(
+                f'array of variable "{variable.name}" has {axis_size} cells along dimension "{dimension.name}" of size {dimension.size}')
+    for dimension, index in fixed_dimension_dict.items():
+        if index is None or index < 0 or index >= dimension.size:
+            raise ValueError(
+                f'array of variable "{variable.name}" has index {index} out of range for dimension "{dimension.name}" of size {dimension.size}')
+
+
+def _to_float_array(array) -> np.ndarray:
+    return np.ma.filled(np.ma.asarray(array, dtype=float), np.nan)
+
+
+_STORAGE_DTYPES = ['float64', 'float32', 'int8', 'int16', 'int32']
+
+
+def _validate_variable_storage(variable: Variable):
+    storage = variable.storage
+    if storage is None:
+        return
+    if storage.dtype not in _STORAGE_DTYPES:
+        raise ValueError(
+            f'unknown storage dtype "{storage.dtype}" of variable "{variable.name}", expected one of {_STORAGE_DTYPES}')
+    if not storage.scale_factor:
+        raise ValueError(
+            f'storage scale_factor of variable "{variable.name}" cannot be 0')
+
+
+def _get_fill_value(storage: VariableStorage):
+    if storage.fill_value is not None:
+        return storage.fill_value
+    if np.issubdtype(np.dtype(storage.dtype), np.integer):
+        return int(np.iinfo(storage.dtype).min)
+    return None
+
+
+def _quantize(array: np.ndarray, storage: VariableStorage) -> np.ndarray:
+    # the stored numbers, still as floats with NaN where missing
+    packed = (np.asarray(array, dtype=float) -
+              storage.add_offset) / storage.scale_factor
+    if not np.issubdtype(np.dtype(storage.dtype), np.integer):
+        return packed.astype(storage.dtype).astype(float)
+    packed = np.round(packed)
+    dtype_info = np.iinfo(storage.dtype)
+    with np.errstate(invalid='ignore'):
+        invalid = (packed < dtype_info.min) | (packed > dtype_info.max) | (
+            packed == _get_fill_value(storage))
+    if invalid.any():
+        raise ValueError(
+            f'values {(packed[invalid][:5] * storage.scale_factor + storage.add_offset).tolist()} cannot be packed into {storage}')
+    return packed
+
+
+def _dequantize(packed: np.ndarray, storage: VariableStorage, out: np.ndarray = None) -> np.ndarray:
+    result = np.array(packed, dtype=float) if out is None else out
+    fill_value = _get_fill_value(storage)
+    if fill_value is not None:
+        result[result == fill_value] = np.nan
+    if storage.scale_factor != 1:
+        result *= storage.scale_factor
+    if storage.add_offset != 0:
+        result += storage.add_offset
+    return result
+
+
+def _encode_storage(array: np.ndarray, storage: VariableStorage) -> np.ndarray:
+    # float cells to the stored dtype, for chunks that cannot hold NULL
+    packed = _quantize(array, storage)
+    fill_value = _get_fill_value(storage)
+    if fill_value is not None:
+        packed[np.isnan(packed)] = fill_value
+    return packed.astype(storage.dtype)
+
+
+def _get_value_sql(storage: VariableStorage, column: str = 'value'):
+    # NULL stands in for missing values in the value table, so only the
+    # packing has to be undone
+    if storage is None or (storage.scale_factor == 1 and storage.add_offset == 0):
+        return column
+    return f'({column} * {float(storage.scale_factor)!r} + {float(storage.add_offset)!r})'
+
+
+def _get_quantized_sql(storage: VariableStorage, sql: str):
+    if storage is None:
+        return sql
+    packed_sql = f'(({sql} - {float(storage.add_offset)!r}) / {float(storage.scale_factor)!r})'
+    if np.issubdtype(np.dtype(storage.dtype), np.integer):
+        return f'ROUND({packed_sql})'
+    return packed_sql
+
+
+def _validate_packed_value_rows(db_connection: sqlite3.Connection, variable: Variable):
+    # the range check of _quantize, for rows packed in SQL
+    storage = variable.storage
+    if storage is None or not np.issubdtype(np.dtype(storage.dtype), np.integer):
+        return
+    dtype_info = np.iinfo(storage.dtype)
+    db_cursor = db_connection.cursor()
+    db_cursor.execute('SELECT value FROM value WHERE variable = ? AND (value < ? OR value > ? OR value = ?) LIMIT 5', [
+                      variable.id, int(dtype_info.min), int(dtype_info.max), _get_fill_value(storage)])
+    packed = list(map(lambda row: row[0], db_cursor.fetchall()))
+    if len(packed) > 0:
+        raise ValueError(
+            f'values {list(map(lambda value: value * storage.scale_factor + storage.add_offset, packed))} cannot be packed into {storage}')
+
+
+def _iter_variable_array_slabs(variable_array: VariableArray, slab_cells: int):
+    # memory-mapped arrays are read a slab of locations at a time rather than
+    # being loaded whole; the other arrays are already in memory
+    array = variable_array.array
+    if not isinstance(array, np.memmap):
+        yield variable_array
+        return
+    location_count = array.shape[variable_array.location_axis]
+    slab_location_count = max(
+        slab_cells // max(array.size // max(location_count, 1), 1), 1)
+    location_ids = np.asarray(variable_array.location_ids)
+    for start in range(0, location_count, slab_location_count):
+        index = [slice(None)] * array.ndim
+        index[variable_array.location_axis] = slice(
+            start, start + slab_location_count)
+        yield replace(variable_array, array=np.asarray(array[tuple(index)]), location_ids=location_ids[start:start + slab_location_count])
+
+
+def _iter_variable_array_rows(variable_array: VariableArray, chunk_size: int, skip_null: bool = False):
+    array = np.moveaxis(_to_float_array(variable_array.array),
+                        variable_array.location_axis, 0)
+    _validate_variable_array(variable_array, array)
+    fixed_dimension_dict = variable_array.dimension_dict or {}
+    dimension_ids = tuple(map(lambda dimension: dimension.id, list(
+        variable_array.dimensions or []) + list(fixed_dimension_dict.keys())))
+    location_ids = np.asarray(variable_array.location_ids)
+    flat_values = array.ravel()
+    non_null_flat_indices = np.flatnonzero(
+        ~np.isnan(flat_values)) if skip_null else None
+    row_count = flat_values.size if non_null_flat_indices is None else non_null_flat_indices.size
+    for start in range(0, row_count, chunk_size):
+        flat_indices = np.arange(start, min(start + chunk_size, row_count))
+        if non_null_flat_indices is not None:
+            flat_indices = non_null_flat_indices[flat_indices]
+        indices = np.unravel_index(flat_indices, array.shape)
+        columns = [
+            location_ids[indices[0]].tolist(),
+            [variable_array.variable.id] * flat_indices.size,
+            *map(lambda axis_indices: axis_indices.tolist(), indices[1:]),
+            *map(lambda index: [index] * flat_indices.size,
+                 fixed_dimension_dict.values()),
+            list(map(lambda value: None if value != value else value,
+                     flat_values[flat_indices].tolist()))
+        ]
+        yield dimension_ids, list(zip(*columns))
+
+
+class _ValueStatsAccumulator:
+    # running (min, max, sum, count, null count, histogram) per variable and
+    # dimension slice; chunks are reduced in NumPy and merged per slice
+    def __init__(self, histogram_bins: int = 0, histogram_ranges: Dict[int, Tuple[float, float]] = None):
+        self.histogram_bins = histogram_bins
+        self.histogram_ranges = histogram_ranges or {}
+        self.stats = {}
+
+    @property
+    def variable_ids(self):
+        return set(map(lambda key: key[0], self.stats.keys()))
+
+    def _get_histograms(self, variable_id: int, values: np.ndarray, group_indices: np.ndarray, group_count: int):
+        value_range = self.histogram_ranges.get(variable_id)
+        if self.histogram_bins <= 0 or value_range is None:
+            return None
+        has_value = ~np.isnan(values)
+        bin_count = self.histogram_bins
+        width = (value_range[1] - value_range[0]) / bin_count
+        bins = np.clip(np.floor((values[has_value] - value_range[0]) / (width or 1)),
+                       0, bin_count - 1).astype(np.int64)
+        return np.bincount(group_indices[has_value] * bin_count + bins,
+                           minlength=group_count * bin_count).reshape(group_count, bin_count)
+
+    def _merge(self, variable_id: int, dimension_ids: Tuple[int, ...], slice_indices: np.ndarray, minima: np.ndarray, maxima: np.ndarray,
+               sums: np.ndarray, counts: np.ndarray, null_counts: np.ndarray, histograms: np.ndarray):
+        for i, (indices, minimum, maximum, total, count, null_count) in enumerate(zip(
+                slice_indices.tolist(), minima.tolist(), maxima.tolist(), sums.tolist(), counts.tolist(), null_counts.tolist())):
+            key = (variable_id, tuple(sorted(zip(dimension_ids, indices))))
+            histogram = None if histograms is None else histograms[i]
+            stats = self.stats.get(key)
+            if stats is None:
+                self.stats[key] = [minimum, maximum, total, int(count), int(null_count),
+                                   None if histogram is None else histogram.copy()]
+                continue
+            stats[0] = min(stats[0], minimum)
+            stats[1] = max(stats[1], maximum)
+            stats[2] += total
+            stats[3] += int(count)
+            stats[4] += int(null_count)
+            if histogram is not None:
+                stats[5] += histogram
+
+    def add_rows(self, variable_id: int, dimension_ids: Tuple[int, ...], dimension_indices: np.ndarray, values: np.ndarray):
+        # rows of one variable, in any order of slices
+        if len(values) == 0:
+            return
+        if len(dimension_ids) == 0:
+            slice_indices = np.zeros((1, 0), dtype=np.int64)
+            group_indices = np.zeros(len(values), dtype=np.int64)
+        else:
+            # one integer key per slice is much cheaper to group than rows
+            shape = tuple((dimension_indices.max(axis=0) + 1).tolist())
+            slice_keys, group_indices = np.unique(np.ravel_multi_index(
+                dimension_indices.T, shape), return_inverse=True)
+            slice_indices = np.column_stack(
+                np.unravel_index(slice_keys, shape))
+            group_indices = group_indices.ravel()
+        group_count = len(slice_indices)
+        has_value = ~np.isnan(values)
+        counts = np.bincount(group_indices, weights=has_value,
+                             minlength=group_count)
+        minima = np.full(group_count, np.inf)
+        maxima = np.full(group_count, -np.inf)
+        np.fmin.at(minima, group_indices, values)
+        np.fmax.at(maxima, group_indices, values)
+        self._merge(variable_id, dimension_ids, slice_indices, minima, maxima,
+                    np.bincount(group_indices, weights=np.where(
+                        has_value, values, 0), minlength=group_count),
+                    counts, np.bincount(
+                        group_indices, minlength=group_count) - counts,
+                    self._get_histograms(variable_id, values, group_indices, group_count))
+
+    def add_array(self, variable_array: VariableArray):
+        # every slice of the array is reduced over its location axis at once
+        array = np.moveaxis(_to_float_array(variable_array.array),
+                            variable_array.location_axis, 0)
+        slice_shape = array.shape[1:]
+        slice_count = int(np.prod(slice_shape))
+        array = array.reshape(array.shape[0], slice_count)
+        fixed_dimension_dict = variable_array.dimension_dict or {}
+        dimension_ids = tuple(map(lambda dimension: dimension.id, list(
+            variable_array.dimensions or []) + list(fixed_dimension_dict.keys())))
+        slice_indices = np.column_stack([
+            *(np.unravel_index(np.arange(slice_count), slice_shape)
+              if len(slice_shape) > 0 else []),
+            *map(lambda index: np.full(slice_count, index),
+                 fixed_dimension_dict.values())
+        ]) if len(dimension_ids) > 0 else np.zeros((1, 0), dtype=np.int64)
+        has_value = ~np.isnan(array)
+        counts = has_value.sum(axis=0)
+        self._merge(variable_array.variable.id, dimension_ids, slice_indices,
+                    np.fmin.reduce(array, axis=0, initial=np.inf),
+                    np.fmax.reduce(array, axis=0, initial=-np.inf),
+                    np.where(has_value, array, 0).sum(axis=0), counts, array.shape[0] - counts,
+                    self._get_histograms(variable_array.variable.id, array.ravel(),
+                                         np.tile(np.arange(slice_count), array.shape[0]), slice_count))
+
+    def add_value_rows(self, pending_rows: Dict[Tuple[int, ...], list]):
+        # rows as queued for the value table: (location, variable, *dimensions, value)
+        for dimension_ids, rows in pending_rows.items():
+            if len(rows) == 0:
+                continue
+            columns = np.array(rows, dtype=float).reshape(
+                len(rows), len(dimension_ids) + 3)
+            variable_ids = columns[:, 1].astype(np.int64)
+            for variable_id in np.unique(variable_ids).tolist():
+                selected = variable_ids == variable_id
+                self.add_rows(variable_id, dimension_ids, columns[selected, 2:-1].astype(
+                    np.int64), columns[selected, -1])
+
+
+def _fill_value_stats_table(db_connection: sqlite3.Connection, value_stats: _ValueStatsAccumulator):
+    rows_by_dimension_ids = {}
+    for (variable_id, dimension_items), (minimum, maximum, total, count, null_count, histogram) in value_stats.stats.items():
+        dimension_ids = tuple(map(lambda item: item[0], dimension_items))
+        value_range = value_stats.histogram_ranges.get(
+            variable_id) if histogram is not None else None
+        rows_by_dimension_ids.setdefault(dimension_ids, []).append((
+            variable_id, *map(lambda item: item[1], dimension_items),
+            minimum if count > 0 else None, maximum if count > 0 else None,
+            total / count if count > 0 else None, count, null_count,
+            value_range[0] if value_range is not None else None,
+            value_range[1] if value_range is not None else None,
+            json.dumps(histogram.tolist()) if histogram is not None else None))
+    for dimension_ids, rows in rows_by_dimension_ids.items():
         sql = f'''
-            INSERT INTO value (
-                location, 
-                variable, 
-                {f', {NEW_LINE_CHARACTER}'.join(dimension_column_names)}{', ' if dimension_column_names is not None else ''}
-                value
-            ) values (?, ?, {''.join(map(lambda dimension: '?, ', dimension_column_names))} ?)
+            INSERT INTO value_stats (variable, {''.join(map(lambda dimension_id: f'dimension_{dimension_id}, ', dimension_ids))}min, max, mean, count, null_count, histogram_min, histogram_max, histogram)
+            values ({', '.join(['?'] * (len(dimension_ids) + 9))})
         '''
-        params = [value.location.id, value.variable.id]
-        for dimension in dimensions:
-            params.append(value.dimension_dict[dimension])
-        params.append(value.value)
-        _execute_sql(db_connection, sql, params)
+        db_connection.executemany(sql, rows)
+
+
+def _refresh_value_stats(db_connection: sqlite3.Connection, variables: Iterable[Variable]):
+    # recomputed from the value table after in-place edits, keeping the
+    # histogram range a variable already had
+    for variable in variables:
+        db_cursor = db_connection.cursor()
+        db_cursor.execute('''
+            SELECT histogram_min, histogram_max, histogram FROM value_stats
+            WHERE variable = ? AND histogram IS NOT NULL LIMIT 1
+        ''', [variable.id])
+        histogram_row = db_cursor.fetchone()
+        if histogram_row is None:
+            value_stats = _ValueStatsAccumulator()
+        else:
+            value_stats = _ValueStatsAccumulator(len(json.loads(histogram_row[2])), {
+                variable.id: (histogram_row[0], histogram_row[1])})
+        _execute_sql(db_connection,
+                     'DELETE FROM value_stats WHERE variable = ?', [variable.id])
+        dimension_ids = tuple(
+            map(lambda dimension: dimension.id, variable.dimensions or []))
+        db_cursor.execute(f'''
+            SELECT {''.join(map(lambda dimension_id: f'dimension_{dimension_id}, ', dimension_ids))}{_get_value_sql(variable.storage)}
+            FROM value WHERE variable = ?
+        ''', [variable.id])
+        while True:
+            rows = db_cursor.fetchmany(100000)
+            if len(rows) == 0:
+                break
+            columns = np.array(rows, dtype=float).reshape(
+                len(rows), len(dimension_ids) + 1)
+            value_stats.add_rows(variable.id, dimension_ids,
+                                 columns[:, :-1].astype(np.int64), columns[:, -1])
+        _fill_value_stats_table(db_connection, value_stats)
+
+
+_PYRAMID_METHODS = {
+    'mean': (np.add, 0.0),
+    'sum': (np.add, 0.0),
+    'min': (np.fmin, np.inf),
+    'max': (np.fmax, -np.inf),
+}
+
+
+class _ValuePyramidAccumulator:
+    # per variable slice and level, a (coarse step, location) grid of running
+    # aggregates and counts; columns are added as new location ids arrive
+    def __init__(self, dimension_id: int, factors: Sequence[int], sizes: Sequence[int], method: str = 'mean'):
+        if method not in _PYRAMID_METHODS:
+            raise ValueError(
+                f'unknown pyramid method "{method}", expected one of {list(_PYRAMID_METHODS.keys())}')
+        self.dimension_id = dimension_id
+        self.factors = list(factors)
+        self.sizes = list(sizes)
+        self.method = method
+        self.ufunc, self.initial = _PYRAMID_METHODS[method]
+        self.location_ids = []
+        self.grids = {}
+        self._location_indices = {}
+        self._capacity = 0
+        self._last_array_location_ids = None
+        self._last_array_location_indices = None
+
+    @property
+    def variable_ids(self):
+        return set(map(lambda key: key[0], self.grids.keys()))
+
+    def _get_location_indices(self, location_ids: np.ndarray):
+        unique_location_ids, inverse = np.unique(
+            location_ids, return_inverse=True)
+        indices = np.empty(len(unique_location_ids), dtype=np.int64)
+        for i, location_id in enumerate(unique_location_ids.tolist()):
+            index = self._location_indices.get(location_id)
+            if index is None:
+                index = self._location_indices[location_id] = len(
+                    self.location_ids)
+                self.location_ids.append(location_id)
+            indices[i] = index
+        return indices[inverse.ravel()]
+
+    def _reserve(self):
+        if len(self.location_ids) <= self._capacity:
+            return
+        capacity = max(len(self.location_ids), self._capacity * 2)
+        for grids in self.grids.values():
+            for grid in grids:
+                grid[0] = np.concatenate([grid[0], np.full(
+                    (grid[0].shape[0], capacity - self._capacity), self.initial)], axis=1)
+                grid[1] = np.concatenate([grid[1], np.zeros(
+                    (grid[1].shape[0], capacity - self._capacity), dtype=np.int64)], axis=1)
+        self._capacity = capacity
+
+    def _get_grids(self, key):
+        grids = self.grids.get(key)
+        if grids is None:
+            grids = self.grids[key] = list(map(lambda size: [np.full(
+                (size, self._capacity), self.initial), np.zeros((size, self._capacity), dtype=np.int64)], self.sizes))
+        return grids
+
+    def add_rows(self, variable_id: int, dimension_ids: Tuple[int, ...], location_indices: np.ndarray, dimension_indices: np.ndarray, values: np.ndarray):
+        if self.dimension_id not in dimension_ids:
+            return
+        has_value = ~np.isnan(values)
+        if not has_value.all():
+            location_indices = location_indices[has_value]
+            dimension_indices = dimension_indices[has_value]
+            values = values[has_value]
+        if len(values) == 0:
+            return
+        self._reserve()
+        axis = dimension_ids.index(self.dimension_id)
+        steps = dimension_indices[:, axis]
+        other_dimension_ids = dimension_ids[:axis] + dimension_ids[axis + 1:]
+        other_dimension_indices = np.delete(dimension_indices, axis, axis=1)
+        if len(other_dimension_ids) == 0:
+            slice_indices = [[]]
+            group_indices = np.zeros(len(values), dtype=np.int64)
+        else:
+            shape = tuple((other_dimension_indices.max(axis=0) + 1).tolist())
+            slice_keys, group_indices = np.unique(np.ravel_multi_index(
+                other_dimension_indices.T, shape), return_inverse=True)
+            slice_indices = np.column_stack(
+                np.unravel_index(slice_keys, shape)).tolist()
+            group_indices = group_indices.ravel()
+        for group, slice_index in enumerate(slice_indices):
+            selected = group_indices == group if len(
+                slice_indices) > 1 else slice(None)
+            grids = self._get_grids(
+                (variable_id, tuple(sorted(zip(other_dimension_ids, slice_index)))))
+            for (aggregates, counts), factor in zip(grids, self.factors):
+                flat_indices = (steps[selected] // factor) * \
+                    self._capacity + location_indices[selected]
+                np.add.at(counts.reshape(-1), flat_indices, 1)
+                self.ufunc.at(aggregates.reshape(-1),
+                              flat_indices, values[selected])
+
+    def add_array(self, variable_array: VariableArray):
+        fixed_dimension_dict = variable_array.dimension_dict or {}
+        dimension_ids = tuple(map(lambda dimension: dimension.id, list(
+            variable_array.dimensions or []) + list(fixed_dimension_dict.keys())))
+        if self.dimension_id not in dimension_ids:
+            return
+        array = np.moveaxis(_to_float_array(variable_array.array),
+                            variable_array.location_axis, 0)
+        flat_values = array.ravel()
+        flat_indices = np.flatnonzero(~np.isnan(flat_values))
+        indices = np.unravel_index(flat_indices, array.shape)
+        # converters pass the same location id array with every time step
+        if variable_array.location_ids is not self._last_array_location_ids:
+            self._last_array_location_ids = variable_array.location_ids
+            self._last_array_location_indices = self._get_location_indices(
+                np.asarray(variable_array.location_ids))
+        dimension_indices = np.column_stack([
+            *indices[1:],
+            *map(lambda index: np.full(flat_indices.size, index),
+                 fixed_dimension_dict.values())
+        ]).astype(np.int64)
+        self.add_rows(variable_array.variable.id, dimension_ids, self._last_array_location_indices[indices[0]],
+                      dimension_indices, flat_values[flat_indices])
+
+    def add_value_rows(self, pending_rows: Dict[Tuple[int, ...], list]):
+        for dimension_ids, rows in pending_rows.items():
+            if len(rows) == 0 or self.dimension_id not in dimension_ids:
+                continue
+            columns = np.array(rows, dtype=float).reshape(
+                len(rows), len(dimension_ids) + 3)
+            location_indices = self._get_location_indices(
+                columns[:, 0].astype(np.int64))
+            variable_ids = columns[:, 1].astype(np.int64)
+            for variable_id in np.unique(variable_ids).tolist():
+                selected = variable_ids == variable_id
+                self.add_rows(variable_id, dimension_ids, location_indices[selected],
+                              columns[selected, 2:-1].astype(np.int64), columns[selected, -1])
+
+    def iter_rows(self):
+        # (dimension ids, rows) with rows as (level, location, variable, *dimensions, value)
+        location_ids = np.asarray(self.location_ids, dtype=np.int64)
+        for (variable_id, dimension_items), grids in self.grids.items():
+            dimension_ids = tuple(
+                map(lambda item: item[0], dimension_items)) + (self.dimension_id,)
+            for level, (aggregates, counts) in enumerate(grids):
+                steps, locations = np.nonzero(counts)
+                values = aggregates[steps, locations]
+                if self.method == 'mean':
+                    values = values / counts[steps, locations]
+                yield dimension_ids, list(zip(
+                    [level] * steps.size,
+                    location_ids[locations].tolist(),
+                    [variable_id] * steps.size,
+                    *map(lambda item: [item[1]] * steps.size, dimension_items),
+                    steps.tolist(),
+                    values.tolist()))
+
+
+def _fill_pyramid_level_table(db_connection: sqlite3.Connection, value_pyramid: _ValuePyramidAccumulator):
+    sql = '''
+        INSERT INTO pyramid_level (level, dimension, factor, size, method) values (?, ?, ?, ?, ?)
+    '''
+    for level, (factor, size) in enumerate(zip(value_pyramid.factors, value_pyramid.sizes)):
+        _execute_sql(db_connection, sql, [
+                     level, value_pyramid.dimension_id, factor, size, value_pyramid.method])
+
+
+def _fill_value_pyramid_table(db_connection: sqlite3.Connection, value_pyramid: _ValuePyramidAccumulator):
+    for dimension_ids, rows in value_pyramid.iter_rows():
+        sql = f'''
+            INSERT INTO value_pyramid (level, location, variable, {''.join(map(lambda dimension_id: f'dimension_{dimension_id}, ', dimension_ids))}value)
+            values ({', '.join(['?'] * (len(dimension_ids) + 4))})
+        '''
+        db_connection.executemany(sql, rows)
+
+
+def _refresh_value_pyramid(db_connection: sqlite3.Connection, variables: Iterable[Variable]):
+    db_cursor = db_connection.cursor()
+    db_cursor.execute(
+        'SELECT dimension, factor, size, method FROM pyramid_level ORDER BY level')
+    levels = db_cursor.fetchall()
+    if len(levels) == 0:
+        return
+    for variable in variables:
+        _execute_sql(db_connection,
+                     'DELETE FROM value_pyramid WHERE variable = ?', [variable.id])
+        value_pyramid = _ValuePyramidAccumulator(levels[0][0], list(map(lambda level: level[1], levels)),
+                                                 list(map(lambda level: level[2], levels)), levels[0][3])
+        dimension_ids = tuple(
+            map(lambda dimension: dimension.id, variable.dimensions or []))
+        if value_pyramid.dimension_id not in dimension_ids:
+            continue
+        db_cursor.execute(f'''
+            SELECT location, {''.join(map(lambda dimension_id: f'dimension_{dimension_id}, ', dimension_ids))}{_get_value_sql(variable.storage)}
+            FROM value WHERE variable = ?
+        ''', [variable.id])
+        while True:
+            rows = db_cursor.fetchmany(100000)
+            if len(rows) == 0:
+                break
+            columns = np.array(rows, dtype=float).reshape(
+                len(rows), len(dimension_ids) + 2)
+            value_pyramid.add_rows(variable.id, dimension_ids, value_pyramid._get_location_indices(
+                columns[:, 0].astype(np.int64)), columns[:, 1:-1].astype(np.int64), columns[:, -1])
+        _fill_value_pyramid_table(db_connection, value_pyramid)
+
+
+def _refresh_derived_value_tables(db_connection: sqlite3.Connection, variables: Sequence[Variable]):
+    # stats, pyramids and series copy the value table, so edits made in place
+    # recompute them for the variables that were touched
+    if _has_table(db_connection, 'value_stats'):
+        _refresh_value_stats(db_connection, variables)
+    if _has_table(db_connection, 'value_pyramid'):
+        _refresh_value_pyramid(db_connection, variables)
+    if _has_table(db_connection, 'value_series'):
+        _refresh_value_series(db_connection, variables)
+
+
+def _get_database_path(db_connection: sqlite3.Connection):
+    db_cursor = db_connection.cursor()
+    db_cursor.execute('PRAGMA database_list')
+    return next(filter(lambda row: row[1] == 'main', db_cursor.fetchall()))[2]
+
+
+def _get_scratch_directory(db_connection: sqlite3.Connection):
+    # the scratch cubes are as large as the arrays, so they go next to the
+    # database rather than into a temp directory that may be held in RAM;
+    # None (the temp directory) for in-memory databases
+    path = _get_database_path(db_connection)
+    return os.path.dirname(os.path.abspath(path)) if path else None
+
+
+def _get_value_array_path(db_connection: sqlite3.Connection, backend: str):
+    # relative to the database, so that the pair can be moved together
+    if backend == 'npy_directory':
+        return f'{os.path.basename(_get_database_path(db_connection))}.chunks'
+    return None
+
+
+def _get_chunk_store(db_connection: sqlite3.Connection, backend: str, path: str = None):
+    if backend == 'sqlite_chunks':
+        return SQLiteChunkStore(db_connection)
+    if backend == 'npy_directory':
+        return NpyDirectoryChunkStore(os.path.join(os.path.dirname(_get_database_path(db_connection)), path))
+    raise ValueError(
+        f'unknown value backend "{backend}", expected one of {VALUE_BACKENDS}')
+
+
+class _ValueArrayWriter:
+    # takes the place of value rows for the chunked backends; fed through the
+    # same hooks as the stats and pyramid accumulators
+    def __init__(self, variables: Sequence[Variable], location_ids: Sequence[int], chunk_cells: int, scratch_directory: str = None):
+        self.variables_by_id = dict(
+            map(lambda variable: (variable.id, variable), variables))
+        self.location_ids = np.asarray(location_ids, dtype=np.int64)
+        self.chunk_cells = chunk_cells
+        self.writer = ChunkedArrayWriter(
+            self.location_ids, scratch_directory)
+
+    def _get_variable(self, variable_id: int):
+        # None for the variables this writer does not collect
+        variable = self.variables_by_id.get(variable_id)
+        if variable is not None and variable_id not in self.writer.arrays:
+            self.writer.add_variable(variable_id, list(
+                map(lambda dimension: dimension.size, variable.dimensions or [])))
+        return variable
+
+    def add_array(self, variable_array: VariableArray):
+        array = np.moveaxis(_to_float_array(variable_array.array),
+                            variable_array.location_axis, 0)
+        _validate_variable_array(variable_array, array)
+        variable = self._get_variable(variable_array.variable.id)
+        if variable is None:
+            return
+        array_dimension_ids = list(
+            map(lambda dimension: dimension.id, variable_array.dimensions or []))
+        fixed_indices = dict(map(lambda item: (
+            item[0].id, item[1]), (variable_array.dimension_dict or {}).items()))
+        index = []
+        axes = []
+        for dimension in variable.dimensions or []:
+            if dimension.id in fixed_indices:
+                index.append(fixed_indices[dimension.id])
+            else:
+                axis = array_dimension_ids.index(dimension.id) + 1
+                index.append(slice(0, array.shape[axis]))
+                axes.append(axis)
+        self.writer.write(variable.id, variable_array.location_ids, tuple(index),
+                          np.transpose(array, [0, *axes]))
+
+    def add_value_rows(self, pending_rows: Dict[Tuple[int, ...], list]):
+        for dimension_ids, rows in pending_rows.items():
+            if len(rows) == 0:
+                continue
+            columns = np.array(rows, dtype=float).reshape(
+                len(rows), len(dimension_ids) + 3)
+            variable_ids = columns[:, 1].astype(np.int64)
+            for variable_id in np.unique(variable_ids).tolist():
+                variable = self._get_variable(variable_id)
+                if variable is None:
+                    continue
+                selected = variable_ids == variable_id
+                dimension_columns = list(map(lambda dimension: dimension_ids.index(
+                    dimension.id) + 2, variable.dimensions or []))
+                self.writer.write_cells(variable_id, columns[selected, 0].astype(np.int64),
+                                        columns[selected][:, dimension_columns], columns[selected, -1])
+
+    def _get_chunk_shape(self, variable: Variable):
+        # `chunk_cells` is counted in float64 cells, so packed variables get
+        # as many bytes per chunk in more cells
+        itemsize = np.dtype(
+            variable.storage.dtype if variable.storage is not None else CHUNK_DTYPE).itemsize
+        return get_chunk_shape([self.location_ids.size, *map(lambda dimension: dimension.size, variable.dimensions or [])],
+                               self.chunk_cells * CHUNK_DTYPE.itemsize // itemsize)
+
+    def finish(self, db_connection: sqlite3.Connection, backend: str):
+        path = _get_value_array_path(db_connection, backend)
+        store = _get_chunk_store(db_connection, backend, path)
+        store.create()
+        chunk_shapes = dict(map(lambda variable: (variable.id, self._get_chunk_shape(
+            variable)), self.variables_by_id.values()))
+        self.writer.finish(store, chunk_shapes, dict(map(lambda variable: (variable.id, lambda array, storage=variable.storage: _encode_storage(array, storage)), filter(
+            lambda variable: variable.storage is not None, self.variables_by_id.values()))))
+        # variables without any value still get their (empty) array
+        for variable in self.variables_by_id.values():
+            shape = [self.location_ids.size, *
+                     map(lambda dimension: dimension.size, variable.dimensions or [])]
+            _execute_sql(db_connection, 'INSERT INTO value_array (variable, backend, shape, chunk_shape, location_ids, path) VALUES (?, ?, ?, ?, ?, ?)', [
+                variable.id, backend, json.dumps(shape), json.dumps(
+                    list(chunk_shapes[variable.id])),
+                self.location_ids.tobytes(), path])
+
+
+class _ValueSeriesWriter(_ValueArrayWriter):
+    # collects the variables spanning the series dimension the same way, then
+    # packs every series into one float32 BLOB row
+    def __init__(self, variables: Sequence[Variable], location_ids: Sequence[int], dimension_id: int, scratch_directory: str = None):
+        super().__init__(list(filter(lambda variable: dimension_id in map(
+            lambda dimension: dimension.id, variable.dimensions or []), variables)), location_ids, None, scratch_directory)
+        self.dimension_id = dimension_id
+
+    def finish(self, db_connection: sqlite3.Connection, block_size: int = 4096):
+        for variable_id, array in self.writer.arrays.items():
+            dimension_ids = list(map(
+                lambda dimension: dimension.id, self.variables_by_id[variable_id].dimensions))
+            series_axis = dimension_ids.index(self.dimension_id)
+            other_dimension_ids = dimension_ids[:series_axis] + \
+                dimension_ids[series_axis + 1:]
+            array = np.moveaxis(array, series_axis + 1, -1)
+            sql = f'''
+                INSERT INTO value_series (location, variable, {''.join(map(lambda dimension_id: f'dimension_{dimension_id}, ', other_dimension_ids))}series)
+                values ({', '.join(['?'] * (len(other_dimension_ids) + 3))})
+            '''
+            for start in range(0, array.shape[0], block_size):
+                block = np.ascontiguousarray(
+                    array[start:start + block_size], dtype='<f4')
+                series = block.reshape(-1, block.shape[-1])
+                flat_indices = np.flatnonzero(~np.isnan(series).all(axis=1))
+                indices = np.unravel_index(flat_indices, block.shape[:-1])
+                db_connection.executemany(sql, zip(
+                    self.location_ids[start + indices[0]].tolist(),
+                    [variable_id] * flat_indices.size,
+                    *map(lambda axis_indices: axis_indices.tolist(), indices[1:]),
+                    map(lambda row: row.tobytes(), series[flat_indices])))
+
+
+def _fill_series_dimension_table(db_connection: sqlite3.Connection, dimension_id: int):
+    _execute_sql(db_connection,
+                 'INSERT INTO series_dimension (dimension) values (?)', [dimension_id])
+
+
+def _refresh_value_series(db_connection: sqlite3.Connection, variables: Iterable[Variable]):
+    db_cursor = db_connection.cursor()
+    db_cursor.execute('SELECT dimension FROM series_dimension')
+    row = db_cursor.fetchone()
+    if row is None:
+        return
+    db_cursor.execute('SELECT id FROM location ORDER BY id')
+    value_series_writer = _ValueSeriesWriter(variables, list(
+        map(lambda row: row[0], db_cursor.fetchall())), row[0], _get_scratch_directory(db_connection))
+    try:
+        for variable in variables:
+            _execute_sql(db_connection,
+                         'DELETE FROM value_series WHERE variable = ?', [variable.id])
+            if variable.id not in value_series_writer.variables_by_id:
+                continue
+            dimension_ids = tuple(
+                map(lambda dimension: dimension.id, variable.dimensions))
+            db_cursor.execute(f'''
+                SELECT location, variable, {''.join(map(lambda dimension_id: f'dimension_{dimension_id}, ', dimension_ids))}{_get_value_sql(variable.storage)}
+                FROM value WHERE variable = ?
+            ''', [variable.id])
+            while True:
+                rows = db_cursor.fetchmany(100000)
+                if len(rows) == 0:
+                    break
+                value_series_writer.add_value_rows({dimension_ids: rows})
+        value_series_writer.finish(db_connection)
+    finally:
+        value_series_writer.writer.close()
+
+
+def _fill_value_table(db_connection: sqlite3.Connection, values: Iterable[Value], writer_options: WriterOptions, commit: bool = True, or_replace: bool = False,
+                      accumulators: Sequence[Union[_ValueStatsAccumulator, _ValuePyramidAccumulator, _ValueArrayWriter, _ValueSeriesWriter]] = (),
+                      storages_by_variable_id: Dict[int, VariableStorage] = None):
+    # values are consumed as a stream, so only up to `chunk_size` rows are held
+    # in memory at a time; rows are grouped by the dimensions they carry so
+    # that every group can be written with a single prepared statement.
+    # Chunks are committed as they are written unless the caller owns the
+    # transaction (`commit=False`). The chunked backends take their values
+    # from the accumulators, so no rows are written for them. Packed
+    # variables are written packed, the accumulators get the values as they
+    # will be read back.
+    storages_by_variable_id = storages_by_variable_id or {}
+    write_rows = writer_options.value_backend == 'table'
+    pending_rows: Dict[Tuple[int, ...], list] = {}
+    # rows of `Value`s still to be added to the accumulators (stats,
+    # pyramids); arrays are added whole
+    pending_accumulator_rows: Dict[Tuple[int, ...], list] = {}
+    pending_count = 0
+    validated_signatures = set()
+
+    def flush():
+        _flush_value_rows(db_connection, pending_rows, commit, or_replace)
+        for accumulator in accumulators:
+            accumulator.add_value_rows(pending_accumulator_rows)
+        pending_accumulator_rows.clear()
+
+    for value in chain.from_iterable(map(lambda value: _iter_variable_array_slabs(value, writer_options.chunk_size) if isinstance(value, VariableArray) else (value,), values)):
+        if isinstance(value, VariableArray):
+            storage = storages_by_variable_id.get(value.variable.id)
+            stored_value = value
+            if storage is not None:
+                packed = _quantize(_to_float_array(value.array), storage)
+                stored_value = replace(value, array=packed)
+                value = replace(value, array=_dequantize(packed, storage))
+            for dimension_ids, array_rows in (_iter_variable_array_rows(stored_value, writer_options.chunk_size) if write_rows else ()):
+                pending_rows.setdefault(dimension_ids, []).extend(array_rows)
+                pending_count += len(array_rows)
+                if pending_count >= writer_options.chunk_size:
+                    flush()
+                    pending_count = 0
+            for accumulator in accumulators:
+                accumulator.add_array(value)
+            continue
+        dimension_dict = value.dimension_dict or {}
+        dimension_ids = tuple(
+            dimension.id for dimension in dimension_dict.keys())
+        _validate_value_dimensions(
+            value, dimension_dict, dimension_ids, validated_signatures)
+        row = (value.location.id, value.variable.id,
+               *dimension_dict.values(), value.value)
+        stored_row = row
+        storage = storages_by_variable_id.get(value.variable.id)
+        if storage is not None and value.value is not None:
+            packed = _quantize([value.value], storage)
+            stored_row = (*row[:-1], None if np.isnan(packed[0])
+                          else float(packed[0]))
+            row = (*row[:-1], float(_dequantize(packed, storage)[0]))
+        if write_rows:
+            rows = pending_rows.get(dimension_ids)
+            if rows is None:
+                rows = pending_rows[dimension_ids] = []
+            rows.append(stored_row)
+        if len(accumulators) > 0:
+            pending_accumulator_rows.setdefault(
+                dimension_ids, []).append(row)
+        pending_count += 1
+        if pending_count >= writer_options.chunk_size:
+            flush()
+            pending_count = 0
+    flush()
+
+
+def _get_pyramid_dimension(dimensions: Sequence[Dimension], writer_options: WriterOptions):
+    pyramid_dimension = next(filter(
+        lambda dimension: dimension.name == writer_options.pyramid_dimension, dimensions), None)
+    if pyramid_dimension is None:
+        raise ValueError(
+            f'pyramid dimension "{writer_options.pyramid_dimension}" does not exist')
+    if any(map(lambda factor: factor < 2, writer_options.pyramid_factors)):
+        raise ValueError('pyramid factors have to be at least 2')
+    if writer_options.pyramid_method not in _PYRAMID_METHODS:
+        raise ValueError(
+            f'unknown pyramid method "{writer_options.pyramid_method}", expected one of {list(_PYRAMID_METHODS.keys())}')
+    return pyramid_dimension
+
+
+def _get_series_dimension(dimensions: Sequence[Dimension], writer_options: WriterOptions):
+    series_dimension = next(filter(
+        lambda dimension: dimension.name == writer_options.series_dimension, dimensions), None)
+    if series_dimension is None:
+        raise ValueError(
+            f'series dimension "{writer_options.series_dimension}" does not exist')
+    return series_dimension
+
+
+def _get_value_pyramid(dimensions: Sequence[Dimension], writer_options: WriterOptions):
+    pyramid_dimension = _get_pyramid_dimension(dimensions, writer_options)
+    return _ValuePyramidAccumulator(pyramid_dimension.id, writer_options.pyramid_factors, list(map(
+        lambda factor: -(-pyramid_dimension.size // factor), writer_options.pyramid_factors)), writer_options.pyramid_method)
+
+
+def _get_location_ids(db_connection: sqlite3.Connection):
+    db_cursor = db_connection.cursor()
+    db_cursor.execute('SELECT id FROM location ORDER BY id')
+    return list(map(lambda row: row[0], db_cursor.fetchall()))
 
 
-def _fill_tables(db_connection: sqlite3.Connection, options: Options):
+def _fill_tables(db_connection: sqlite3.Connection, options: Options, writer_options: WriterOptions):
     _fill_info_table(db_connection, options.info)
-    _fill_location_table(db_connection, options.locations)
+    if writer_options.lod_tolerances:
+        _fill_location_lod_level_table(
+            db_connection, writer_options.lod_tolerances)
+    _fill_location_table(db_connection, options.locations, geometry_encoding=writer_options.geometry_encoding,
+                         geometry_precision=writer_options.geometry_precision,
+                         lod_tolerances=writer_options.lod_tolerances, spatial_index=writer_options.spatial_index)
     _fill_dimension_table(db_connection, options.dimensions)
     _fill_variable_table(db_connection, options.variables)
     _fill_variable_dimension_table(db_connection, options.variables)
-    _fill_value_table(db_connection, options.values)
+    if any(map(lambda variable: variable.storage is not None, options.variables)):
+        _create_variable_storage_table(db_connection)
+        _fill_variable_storage_table(db_connection, options.variables)
+    if writer_options.pyramid_factors:
+        _fill_pyramid_level_table(
+            db_connection, _get_value_pyramid(options.dimensions, writer_options))
+    if writer_options.value_series:
+        _fill_series_dimension_table(db_connection, _get_series_dimension(
+            options.dimensions, writer_options).id)
+    db_connection.commit()
+
+
+def _fill_value_tables(db_connection: sqlite3.Connection, options: Options, writer_options: WriterOptions, location_ids: Sequence[int]):
+    # everything written from `options.values`, which is all a shard of
+    # generate_gwfvis_db_in_parallel holds
+    value_stats = None
+    value_pyramid = None
+    if writer_options.value_stats:
+        variable_ids_by_name = dict(
+            map(lambda variable: (variable.name, variable.id), options.variables))
+        # a shard of generate_gwfvis_db_in_parallel only has some of the
+        # variables; the names were checked against all of them
+        value_stats = _ValueStatsAccumulator(writer_options.histogram_bins, dict(map(
+            lambda item: (variable_ids_by_name[item[0]], item[1]), filter(
+                lambda item: item[0] in variable_ids_by_name, (writer_options.histogram_ranges or {}).items()))))
+    if writer_options.pyramid_factors:
+        value_pyramid = _get_value_pyramid(options.dimensions, writer_options)
+    value_array_writer = None
+    value_series_writer = None
+    if writer_options.value_backend != 'table':
+        value_array_writer = _ValueArrayWriter(
+            options.variables, location_ids, writer_options.chunk_cells, _get_scratch_directory(db_connection))
+    if writer_options.value_series:
+        series_dimension = _get_series_dimension(
+            options.dimensions, writer_options)
+        value_series_writer = _ValueSeriesWriter(
+            options.variables, location_ids, series_dimension.id, _get_scratch_directory(db_connection))
+    try:
+        _fill_value_table(db_connection, options.values, writer_options, accumulators=list(
+            filter(lambda accumulator: accumulator is not None, [value_stats, value_pyramid, value_array_writer, value_series_writer])),
+            storages_by_variable_id=dict(map(lambda variable: (variable.id, variable.storage), options.variables)))
+        if value_array_writer is not None:
+            value_array_writer.finish(
+                db_connection, writer_options.value_backend)
+        if value_series_writer is not None:
+            value_series_writer.finish(db_connection)
+    finally:
+        for writer in filter(lambda writer: writer is not None, [value_array_writer, value_series_writer]):
+            writer.writer.close()
+    if value_stats is not None:
+        _fill_value_stats_table(db_connection, value_stats)
+    if value_pyramid is not None:
+        _fill_value_pyramid_table(db_connection, value_pyramid)
+
+
+@contextmanager
+def _transaction(db_connection: sqlite3.Connection):
+    # an explicit BEGIN so that DDL (ALTER TABLE, CREATE TABLE) is rolled back
+    # together with the rows written alongside it
+    if not db_connection.in_transaction:
+        _execute_sql(db_connection, 'BEGIN')
+    try:
+        yield
+    except:
+        db_connection.rollback()
+        raise
+    db_connection.commit()
+
+
+def _has_table(db_connection: sqlite3.Connection, table_name: str):
+    db_cursor = db_connection.cursor()
+    db_cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", [table_name])
+    return db_cursor.fetchone() is not None
 
 
 def _query_db_table(db_connection: sqlite3.Connection, table_name: str, columns: Sequence[str] = None):
@@ -273,73 +1680,1123 @@ def _query_db_table(db_connection: sqlite3.Connection, table_name: str, columns:
     return list(map(lambda row: dict(zip(headers, row)), rows))
 
 
+def _iter_value_rows(db_connection: sqlite3.Connection, locations_by_id: Dict[int, Location], variables_by_id: Dict[int, Variable], dimensions_by_id: Dict[int, Dimension], where: str = '', params: Sequence = ()):
+    storages_by_variable_id = dict(map(lambda variable: (
+        variable.id, variable.storage), filter(lambda variable: variable.storage is not None, variables_by_id.values())))
+    db_cursor = db_connection.cursor()
+    db_cursor.execute(f'SELECT * FROM value {where}', params)
+    headers = list(map(lambda d: d[0], db_cursor.description))
+    location_column_index = headers.index('location')
+    variable_column_index = headers.index('variable')
+    value_column_index = headers.index('value')
+    # resolved once per query rather than once per row
+    dimension_columns = list(map(
+        lambda index_and_header: (
+            index_and_header[0], dimensions_by_id.get(int(index_and_header[1][10:]))),
+        filter(lambda index_and_header: index_and_header[1].startswith(
+            'dimension_'), enumerate(headers))
+    ))
+    while True:
+        rows = db_cursor.fetchmany(10000)
+        if len(rows) == 0:
+            break
+        for row in rows:
+            value = row[value_column_index]
+            storage = storages_by_variable_id.get(row[variable_column_index])
+            if storage is not None and value is not None:
+                value = value * storage.scale_factor + storage.add_offset
+            yield Value(
+                location=locations_by_id.get(row[location_column_index]),
+                variable=variables_by_id.get(row[variable_column_index]),
+                value=value,
+                dimension_dict={
+                    dimension: row[column_index]
+                    for column_index, dimension in dimension_columns
+                    if row[column_index] is not None
+                }
+            )
+
+
+def _to_index_list(index_spec: Union[int, slice, Sequence[int]], size: int):
+    if isinstance(index_spec, slice):
+        return list(range(size))[index_spec]
+    if isinstance(index_spec, (int, np.integer)):
+        return [int(index_spec)]
+    return list(map(int, index_spec))
+
+
+def _build_value_where(variable: Variable = None, location_ids: Sequence[int] = None, dimension_slice: Dict[Dimension, Union[int, slice, Sequence[int]]] = None):
+    conditions = []
+    params = []
+    if variable is not None:
+        conditions.append('variable = ?')
+        params.append(variable.id)
+    if location_ids is not None:
+        conditions.append('location IN (SELECT value FROM json_each(?))')
+        params.append(json.dumps(list(map(int, location_ids))))
+    for dimension, index_spec in (dimension_slice or {}).items():
+        indices = _to_index_list(index_spec, dimension.size)
+        if len(indices) == 1:
+            conditions.append(f'dimension_{dimension.id} = ?')
+            params.append(indices[0])
+        elif len(indices) > 0 and indices == list(range(indices[0], indices[-1] + 1)):
+            conditions.append(f'dimension_{dimension.id} BETWEEN ? AND ?')
+            params.extend([indices[0], indices[-1]])
+        else:
+            conditions.append(
+                f'dimension_{dimension.id} IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps(indices))
+    if len(conditions) == 0:
+        return '', params
+    return f'WHERE {" AND ".join(conditions)}', params
+
+
+_EXPRESSION_SQL_OPERATORS = {
+    ast.Add: '+',
+    ast.Sub: '-',
+    ast.Mult: '*',
+    ast.Div: '/',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+    ast.Eq: '=',
+    ast.NotEq: '!=',
+}
+_EXPRESSION_NUMPY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+_EXPRESSION_FUNCTIONS = {
+    'abs': ('abs', np.abs),
+    'min': ('min', np.fmin),
+    'max': ('max', np.fmax),
+}
+
+
+def _parse_expression(expression: str, variables_by_name: Dict[str, Variable]):
+    """Parse a derived variable expression and return the tree with its operands.
+
+    Expressions are restricted to numbers, variable names, `+ - * /`,
+    unary minus, a single comparison (yielding 1 or 0) and the `abs`, `min`
+    and `max` functions.
+    """
+    tree = ast.parse(expression, mode='eval').body
+    operands = []
+
+    def visit(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return
+        if isinstance(node, ast.Name):
+            variable = variables_by_name.get(node.id)
+            if variable is None:
+                raise ValueError(
+                    f'unknown variable "{node.id}" in expression "{expression}"')
+            if variable not in operands:
+                operands.append(variable)
+            return
+        if isinstance(node, ast.BinOp) and type(node.op) in _EXPRESSION_SQL_OPERATORS:
+            visit(node.left)
+            visit(node.right)
+            return
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            visit(node.operand)
+            return
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _EXPRESSION_SQL_OPERATORS:
+            visit(node.left)
+            visit(node.comparators[0])
+            return
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _EXPRESSION_FUNCTIONS and len(node.keywords) == 0 and len(node.args) == (1 if node.func.id == 'abs' else 2):
+            for arg in node.args:
+                visit(arg)
+            return
+        raise ValueError(
+            f'unsupported syntax "{ast.unparse(node)}" in expression "{expression}"')
+
+    visit(tree)
+    if len(operands) == 0:
+        raise ValueError(
+            f'expression "{expression}" does not reference any variable')
+    return tree, operands
+
+
+def _expression_to_sql(node, aliases: Dict[str, str]):
+    # `aliases` maps a variable name to the SQL reading its value
+    if isinstance(node, ast.Constant):
+        return repr(float(node.value))
+    if isinstance(node, ast.Name):
+        return aliases[node.id]
+    if isinstance(node, ast.BinOp):
+        return f'({_expression_to_sql(node.left, aliases)} {_EXPRESSION_SQL_OPERATORS[type(node.op)]} {_expression_to_sql(node.right, aliases)})'
+    if isinstance(node, ast.UnaryOp):
+        return f'({"-" if isinstance(node.op, ast.USub) else "+"}{_expression_to_sql(node.operand, aliases)})'
+    if isinstance(node, ast.Compare):
+        return f'({_expression_to_sql(node.left, aliases)} {_EXPRESSION_SQL_OPERATORS[type(node.ops[0])]} {_expression_to_sql(node.comparators[0], aliases)})'
+    function_name = _EXPRESSION_FUNCTIONS[node.func.id][0]
+    return f'{function_name}({", ".join(map(lambda arg: _expression_to_sql(arg, aliases), node.args))})'
+
+
+def _evaluate_expression(node, arrays: Dict[str, np.ndarray]):
+    if isinstance(node, ast.Constant):
+        return float(node.value)
+    if isinstance(node, ast.Name):
+        return arrays[node.id]
+    if isinstance(node, ast.BinOp):
+        return _EXPRESSION_NUMPY_OPERATORS[type(node.op)](_evaluate_expression(node.left, arrays), _evaluate_expression(node.right, arrays))
+    if isinstance(node, ast.UnaryOp):
+        operand = _evaluate_expression(node.operand, arrays)
+        return -operand if isinstance(node.op, ast.USub) else operand
+    if isinstance(node, ast.Compare):
+        left = _evaluate_expression(node.left, arrays)
+        right = _evaluate_expression(node.comparators[0], arrays)
+        result = _EXPRESSION_NUMPY_OPERATORS[type(node.ops[0])](
+            left, right).astype(float)
+        # comparisons with a missing operand stay missing, as in SQL
+        return np.where(np.isnan(left) | np.isnan(right), np.nan, result)
+    args = list(map(lambda arg: _evaluate_expression(arg, arrays), node.args))
+    result = _EXPRESSION_FUNCTIONS[node.func.id][1](*args)
+    if len(args) > 1:
+        return np.where(np.isnan(args[0]) | np.isnan(args[1]), np.nan, result)
+    return result
+
+
 # %% exported functions
 
+class GwfVisDB:
+    """An open .gwfvisdb file that is queried on demand.
+
+    The small metadata tables are loaded the first time they are accessed;
+    values are only pulled from SQLite for the variable, locations and
+    dimension slice that are asked for. `dimension_slice` maps a dimension to
+    an index, a `slice` or a sequence of indices.
+    """
+
+    def __init__(self, path_or_connection: Union[str, sqlite3.Connection]):
+        if isinstance(path_or_connection, sqlite3.Connection):
+            self.db_connection = path_or_connection
+        else:
+            self.db_connection = _open_database(path_or_connection)
+        self._info = None
+        self._locations = None
+        self._dimensions = None
+        self._variables = None
+        self._value_arrays = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db_connection.close()
+
+    @property
+    def info(self) -> Sequence[Info]:
+        if self._info is None:
+            query_result = _query_db_table(
+                db_connection=self.db_connection, table_name='info')
+            self._info = list(map(lambda d: Info(
+                key=d['key'], value=d['value'], label=d['label']), query_result))
+        return self._info
+
+    @property
+    def locations(self) -> Sequence[Location]:
+        if self._locations is None:
+            query_result = _query_db_table(
+                db_connection=self.db_connection, table_name='location')
+            self._locations = list(map(lambda d: Location(id=d['id'], geometry=decode_geometry(
+                d['geometry']), metadata=json.loads(d['metadata'])), query_result))
+        return self._locations
+
+    @property
+    def lod_tolerances(self) -> Sequence[float]:
+        """Tolerances of the simplified geometry levels, indexed by level."""
+        if not _has_table(self.db_connection, 'location_lod_level'):
+            return []
+        db_cursor = self.db_connection.cursor()
+        db_cursor.execute(
+            'SELECT tolerance FROM location_lod_level ORDER BY level')
+        return list(map(lambda row: row[0], db_cursor.fetchall()))
+
+    def get_locations(self, lod_level: int = None) -> Sequence[Location]:
+        """Locations with the geometries of a level of detail; a location the
+        level did not simplify keeps its full geometry."""
+        if lod_level is None:
+            return self.locations
+        if lod_level not in range(len(self.lod_tolerances)):
+            raise ValueError(f'level of detail {lod_level} does not exist')
+        db_cursor = self.db_connection.cursor()
+        db_cursor.execute('''
+            SELECT location.id, COALESCE(location_lod.geometry, location.geometry), location.metadata
+            FROM location LEFT JOIN location_lod
+                ON location_lod.level = ? AND location_lod.location = location.id
+        ''', [lod_level])
+        return list(map(lambda row: Location(id=row[0], geometry=decode_geometry(row[1]),
+                                             metadata=json.loads(row[2])), db_cursor.fetchall()))
+
+    def query_locations_by_bbox(self, bbox: Sequence[float], contained: bool = False) -> Sequence[int]:
+        """Ids of the locations whose bbox intersects `bbox`
+        `(min_x, min_y, max_x, max_y)`, or lies inside it when `contained` is
+        set. Uses the R*Tree when the file has one, whose float32 boxes are
+        rounded outwards; otherwise every geometry is decoded and checked."""
+        if _has_table(self.db_connection, 'location_rtree'):
+            if contained:
+                where = 'min_x >= ? AND min_y >= ? AND max_x <= ? AND max_y <= ?'
+            else:
+                where = 'max_x >= ? AND max_y >= ? AND min_x <= ? AND min_y <= ?'
+            db_cursor = self.db_connection.cursor()
+            db_cursor.execute(
+                f'SELECT id FROM location_rtree WHERE {where} ORDER BY id', list(bbox))
+            return list(map(lambda row: row[0], db_cursor.fetchall()))
+        location_ids = []
+        for location in self.locations:
+            location_bbox = get_bbox(location.geometry)
+            if location_bbox is None:
+                continue
+            if contained:
+                selected = location_bbox[0] >= bbox[0] and location_bbox[1] >= bbox[1] and \
+                    location_bbox[2] <= bbox[2] and location_bbox[3] <= bbox[3]
+            else:
+                selected = location_bbox[2] >= bbox[0] and location_bbox[3] >= bbox[1] and \
+                    location_bbox[0] <= bbox[2] and location_bbox[1] <= bbox[3]
+            if selected:
+                location_ids.append(location.id)
+        return sorted(location_ids)
+
+    @property
+    def dimensions(self) -> Sequence[Dimension]:
+        if self._dimensions is None:
+            query_result = _query_db_table(
+                db_connection=self.db_connection, table_name='dimension')
+            self._dimensions = list(map(lambda d: Dimension(id=d['id'], name=d['name'], size=d['size'],
+                                                            description=d['description'], value_labels=json.loads(d['value_labels'])), query_result))
+        return self._dimensions
+
+    @property
+    def variables(self) -> Sequence[Variable]:
+        if self._variables is None:
+            query_result = _query_db_table(
+                db_connection=self.db_connection, table_name='variable')
+            variables = list(map(lambda d: Variable(
+                id=d['id'], name=d['name'], unit=d['unit'], description=d['description'], dimensions=[]), query_result))
+            variables_by_id = dict(
+                map(lambda variable: (variable.id, variable), variables))
+            dimensions_by_id = dict(
+                map(lambda dimension: (dimension.id, dimension), self.dimensions))
+            query_result = _query_db_table(
+                db_connection=self.db_connection, table_name='variable_dimension')
+            for q in query_result:
+                variable = variables_by_id.get(q['variable'])
+                dimension = dimensions_by_id.get(q['dimension'])
+                if (variable is not None and dimension is not None):
+                    variable.dimensions.append(dimension)
+            if _has_table(self.db_connection, 'variable_storage'):
+                for q in _query_db_table(db_connection=self.db_connection, table_name='variable_storage'):
+                    variable = variables_by_id.get(q['variable'])
+                    if variable is not None:
+                        variable.storage = VariableStorage(
+                            dtype=q['dtype'], scale_factor=q['scale_factor'], add_offset=q['add_offset'], fill_value=q['fill_value'])
+            self._variables = variables
+        return self._variables
+
+    def get_variable(self, name: str) -> Variable:
+        return next(filter(lambda variable: variable.name == name, self.variables), None)
+
+    def _get_storage(self, variable: Variable) -> VariableStorage:
+        # as stored, whatever the passed variable object carries
+        return next(map(lambda stored_variable: stored_variable.storage, filter(
+            lambda stored_variable: stored_variable.id == variable.id, self.variables)), None)
+
+    def get_location_ids(self) -> Sequence[int]:
+        db_cursor = self.db_connection.cursor()
+        db_cursor.execute('SELECT id FROM location ORDER BY id')
+        return list(map(lambda row: row[0], db_cursor.fetchall()))
+
+    def iter_values(self, variable: Variable = None, location_ids: Sequence[int] = None, dimension_slice: Dict[Dimension, Union[int, slice, Sequence[int]]] = None) -> Iterator[Value]:
+        value_arrays = self._get_value_arrays()
+        if variable is not None and variable.id in value_arrays:
+            return self._iter_array_values(variable, location_ids, dimension_slice)
+        where, params = _build_value_where(
+            variable, location_ids, dimension_slice)
+        rows = _iter_value_rows(
+            self.db_connection,
+            dict(map(lambda location: (location.id, location), self.locations)),
+            dict(map(lambda variable: (variable.id, variable), self.variables)),
+            dict(map(lambda dimension: (dimension.id, dimension), self.dimensions)),
+            where,
+            params
+        )
+        if variable is None and len(value_arrays) > 0:
+            return chain(rows, *map(lambda variable: self._iter_array_values(variable, location_ids, dimension_slice),
+                                    filter(lambda variable: variable.id in value_arrays, self.variables)))
+        return rows
+
+    def _get_value_arrays(self):
+        # variable id -> (backend, shape, chunk shape, location ids, chunk store)
+        if self._value_arrays is None:
+            self._value_arrays = {}
+            if _has_table(self.db_connection, 'value_array'):
+                db_cursor = self.db_connection.cursor()
+                db_cursor.execute(
+                    'SELECT variable, backend, shape, chunk_shape, location_ids, path FROM value_array')
+                for variable_id, backend, shape, chunk_shape, location_ids, path in db_cursor.fetchall():
+                    self._value_arrays[variable_id] = (backend, json.loads(shape), json.loads(chunk_shape), np.frombuffer(
+                        location_ids, dtype=np.int64), _get_chunk_store(self.db_connection, backend, path))
+        return self._value_arrays
+
+    def get_value_backend(self, variable: Variable) -> str:
+        """`table`, or the chunked backend `variable` is stored with."""
+        value_array = self._get_value_arrays().get(variable.id)
+        return 'table' if value_array is None else value_array[0]
+
+    def _read_value_array(self, variable: Variable, location_ids: Sequence[int], axis_index_lists: Sequence[Sequence[int]], out: np.ndarray = None):
+        _, shape, chunk_shape, stored_location_ids, store = self._get_value_arrays()[
+            variable.id]
+        # the location axis is written in id order
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(
+            stored_location_ids, location_ids), max(stored_location_ids.size - 1, 0))
+        matched = stored_location_ids[positions] == location_ids if stored_location_ids.size > 0 else np.zeros(
+            location_ids.shape, dtype=bool)
+        storage = self._get_storage(variable)
+        if storage is None:
+            return read_chunked_array(store, variable.id, shape, chunk_shape,
+                                      [np.where(matched, positions, -1), *axis_index_lists], out)
+        return read_chunked_array(store, variable.id, shape, chunk_shape, [np.where(matched, positions, -1), *axis_index_lists], out,
+                                  storage.dtype, lambda cells: _dequantize(cells, storage))
+
+    def _iter_array_values(self, variable: Variable, location_ids: Sequence[int] = None, dimension_slice: Dict[Dimension, Union[int, slice, Sequence[int]]] = None):
+        index_specs_by_dimension_id = dict(map(
+            lambda item: (item[0].id, item[1]), (dimension_slice or {}).items()))
+        variable_dimension_ids = set(
+            map(lambda dimension: dimension.id, variable.dimensions or []))
+        # like the value table, a variable has no cells in a dimension it
+        # lacks; unlike it, NULL cells read as NaN and are skipped with the
+        # cells never written
+        if any(map(lambda dimension_id: dimension_id not in variable_dimension_ids, index_specs_by_dimension_id.keys())):
+            return
+        if location_ids is None:
+            location_ids = self._get_value_arrays()[variable.id][3]
+        location_ids = np.asarray(location_ids)
+        axis_index_lists = list(map(lambda dimension: _to_index_list(index_specs_by_dimension_id.get(
+            dimension.id, slice(None)), dimension.size), variable.dimensions or []))
+        array = self._read_value_array(
+            variable, location_ids, axis_index_lists)
+        locations_by_id = dict(
+            map(lambda location: (location.id, location), self.locations))
+        indices = np.nonzero(~np.isnan(array))
+        for cell_indices, value in zip(zip(*map(lambda axis_indices: axis_indices.tolist(), indices)), array[indices].tolist()):
+            yield Value(
+                location=locations_by_id.get(int(location_ids[cell_indices[0]])),
+                variable=variable,
+                value=value,
+                dimension_dict=dict(map(lambda item: (item[0], item[1][item[2]]), zip(
+                    variable.dimensions or [], axis_index_lists, cell_indices[1:])))
+            )
+
+    @property
+    def pyramid_factors(self) -> Sequence[int]:
+        """Aggregation factors of the stored pyramid levels, finest first."""
+        if not _has_table(self.db_connection, 'pyramid_level'):
+            return []
+        db_cursor = self.db_connection.cursor()
+        db_cursor.execute('SELECT factor FROM pyramid_level ORDER BY level')
+        return list(map(lambda row: row[0], db_cursor.fetchall()))
+
+    def get_values_array(self, variable: Variable, location_ids: Sequence[int] = None, dimension_slice: Dict[Dimension, Union[int, slice, Sequence[int]]] = None,
+                         resolution: int = None, out: np.ndarray = None) -> np.ndarray:
+        """Return the values of `variable` as a dense array.
+
+        Axis 0 runs over `location_ids` (all locations, ordered by id, if not
+        given) and the other axes over the variable's dimensions in order.
+        Dimensions sliced with a single integer are dropped from the result.
+        Missing values are NaN. The values are written into `out` instead of
+        a new array if given, e.g. a memory-mapped `.npy` file.
+
+        `resolution` reads the pyramid level with that aggregation factor
+        instead, e.g. `12` for yearly means of monthly steps; the pyramid
+        dimension then counts coarse steps, in its slice as well.
+        """
+        if location_ids is None:
+            location_ids = self.get_location_ids()
+        table_name = 'value'
+        dimensions = list(variable.dimensions)
+        level_conditions = []
+        if resolution not in [None, 1]:
+            db_cursor = self.db_connection.cursor()
+            if _has_table(self.db_connection, 'pyramid_level'):
+                db_cursor.execute(
+                    'SELECT level, dimension, size FROM pyramid_level WHERE factor = ?', [resolution])
+                level_row = db_cursor.fetchone()
+            else:
+                level_row = None
+            if level_row is None:
+                raise ValueError(
+                    f'there is no pyramid level with resolution {resolution}, available: {self.pyramid_factors}')
+            level, pyramid_dimension_id, size = level_row
+            coarse_dimensions = dict(map(lambda dimension: (dimension.id, replace(dimension, size=size)), filter(
+                lambda dimension: dimension.id == pyramid_dimension_id, dimensions)))
+            if len(coarse_dimensions) == 0:
+                raise ValueError(
+                    f'variable "{variable.name}" does not span the pyramid dimension')
+            dimensions = list(map(lambda dimension: coarse_dimensions.get(
+                dimension.id, dimension), dimensions))
+            dimension_slice = dict(map(lambda item: (coarse_dimensions.get(
+                item[0].id, item[0]), item[1]), (dimension_slice or {}).items()))
+            table_name = 'value_pyramid'
+            level_conditions = [level]
+        index_specs_by_dimension_id = dict(map(
+            lambda item: (item[0].id, item[1]), (dimension_slice or {}).items()))
+        axis_indices = []
+        for dimension in dimensions:
+            index_spec = index_specs_by_dimension_id.get(
+                dimension.id, slice(None))
+            axis_indices.append(
+                (dimension, _to_index_list(index_spec, dimension.size), isinstance(index_spec, (int, np.integer))))
+        squeezed_axes = tuple(
+            map(lambda item: item[0] + 1, filter(lambda item: item[1][2], enumerate(axis_indices))))
+        shape = [len(location_ids)] + \
+            list(map(lambda item: len(item[1]), axis_indices))
+        if out is None:
+            array = np.full(shape, np.nan)
+        else:
+            # a view with the squeezed axes put back
+            array = out.reshape(shape)
+            array[...] = np.nan
+        if table_name == 'value' and variable.id in self._get_value_arrays():
+            self._read_value_array(variable, location_ids, list(
+                map(lambda item: item[1], axis_indices)), array)
+            return array.squeeze(axis=squeezed_axes) if out is None else out
+        # lookup tables from stored ids/indices to positions in the array
+        location_ids = np.asarray(location_ids)
+        location_order = np.argsort(location_ids)
+        sorted_location_ids = location_ids[location_order]
+        dimension_lookups = []
+        for dimension, indices, _ in axis_indices:
+            lookup = np.zeros(dimension.size, dtype=int)
+            lookup[indices] = np.arange(len(indices))
+            dimension_lookups.append(lookup)
+        where, params = _build_value_where(
+            variable, location_ids, dimension_slice)
+        if len(level_conditions) > 0:
+            where = f'{where} AND level = ?' if where else 'WHERE level = ?'
+            params.extend(level_conditions)
+        columns = ', '.join(['location'] + list(map(
+            lambda item: f'dimension_{item[0].id}', axis_indices)) + ['value'])
+        db_cursor = self.db_connection.cursor()
+        db_cursor.execute(
+            f'SELECT {columns} FROM {table_name} {where}', params)
+        while True:
+            rows = db_cursor.fetchmany(100000)
+            if len(rows) == 0:
+                break
+            rows = np.array(rows, dtype=float)
+            positions = [location_order[np.searchsorted(
+                sorted_location_ids, rows[:, 0].astype(int))]]
+            for i, lookup in enumerate(dimension_lookups):
+                positions.append(lookup[rows[:, i + 1].astype(int)])
+            array[tuple(positions)] = rows[:, -1]
+        # pyramid aggregates are computed from unpacked values
+        storage = self._get_storage(variable)
+        if table_name == 'value' and storage is not None:
+            _dequantize(array, storage, out=array)
+        return array.squeeze(axis=squeezed_axes) if out is None else out
+
+    def get_series(self, variable: Variable, location_id: int, dimension_dict: Dict[Dimension, int] = None) -> np.ndarray:
+        """Values of `variable` at one location along the one dimension not
+        pinned by `dimension_dict`, NaN where missing. Files written with
+        `value_series` answer from a single float32 row; others gather the
+        series from the values."""
+        dimension_dict = dimension_dict or {}
+        pinned_dimension_ids = set(
+            map(lambda dimension: dimension.id, dimension_dict.keys()))
+        free_dimensions = list(filter(
+            lambda dimension: dimension.id not in pinned_dimension_ids, variable.dimensions or []))
+        if len(free_dimensions) != 1:
+            raise ValueError(
+                f'a series of variable "{variable.name}" needs all but one of its dimensions pinned, {len(free_dimensions)} are free')
+        series_dimension = free_dimensions[0]
+        db_cursor = self.db_connection.cursor()
+        if _has_table(self.db_connection, 'series_dimension'):
+            db_cursor.execute('SELECT dimension FROM series_dimension')
+            stored_dimension_id = db_cursor.fetchone()[0]
+        else:
+            stored_dimension_id = None
+        if series_dimension.id != stored_dimension_id:
+            return self.get_values_array(variable, [location_id], dimension_dict)[0]
+        db_cursor.execute(f'''
+            SELECT series FROM value_series
+            WHERE variable = ? AND location = ?{''.join(map(lambda dimension: f' AND dimension_{dimension.id} = ?', dimension_dict.keys()))}
+        ''', [variable.id, int(location_id), *map(int, dimension_dict.values())])
+        row = db_cursor.fetchone()
+        series = np.frombuffer(
+            row[0], dtype='<f4') if row is not None else np.zeros(0, dtype='<f4')
+        if series.size == series_dimension.size:
+            return series
+        # the dimension has been extended since the series was written
+        padded_series = np.full(series_dimension.size,
+                                np.nan, dtype=np.float32)
+        padded_series[:min(series.size, series_dimension.size)
+                      ] = series[:series_dimension.size]
+        return padded_series
+
+    def get_value_stats(self, variable: Variable, dimension_slice: Dict[Dimension, Union[int, slice, Sequence[int]]] = None) -> Sequence[ValueStats]:
+        """Stored summaries of `variable` per dimension slice, restricted to
+        `dimension_slice`. Files written without stats have them computed
+        from the value table instead (without histograms)."""
+        dimensions_by_id = dict(
+            map(lambda dimension: (dimension.id, dimension), self.dimensions))
+        dimension_ids = list(
+            map(lambda dimension: dimension.id, variable.dimensions or []))
+        where, params = _build_value_where(variable, None, dimension_slice)
+        value_sql = _get_value_sql(self._get_storage(variable))
+        db_cursor = self.db_connection.cursor()
+        if _has_table(self.db_connection, 'value_stats'):
+            db_cursor.execute(f'''
+                SELECT {''.join(map(lambda dimension_id: f'dimension_{dimension_id}, ', dimension_ids))}min, max, mean, count, null_count, histogram_min, histogram_max, histogram
+                FROM value_stats {where}
+            ''', params)
+            rows = db_cursor.fetchall()
+        elif variable.id in self._get_value_arrays():
+            rows = self._get_array_value_stats_rows(
+                variable, dimension_slice)
+        else:
+            db_cursor.execute(f'''
+                SELECT {''.join(map(lambda dimension_id: f'dimension_{dimension_id}, ', dimension_ids))}MIN({value_sql}), MAX({value_sql}), AVG({value_sql}), COUNT(value), COUNT(*) - COUNT(value), NULL, NULL, NULL
+                FROM value {where}
+                {f'GROUP BY {", ".join(map(lambda dimension_id: f"dimension_{dimension_id}", dimension_ids))}' if len(dimension_ids) > 0 else ''}
+            ''', params)
+            rows = list(filter(lambda row: row[len(dimension_ids) + 3] + row[len(dimension_ids) + 4] > 0,
+                               db_cursor.fetchall()))
+        dimension_count = len(dimension_ids)
+        return list(map(lambda row: ValueStats(
+            variable=variable,
+            dimension_dict=dict(zip(map(dimensions_by_id.get, dimension_ids), row[:dimension_count])),
+            min=row[dimension_count], max=row[dimension_count + 1], mean=row[dimension_count + 2],
+            count=row[dimension_count + 3], null_count=row[dimension_count + 4],
+            histogram=json.loads(row[dimension_count + 7]) if row[dimension_count + 7] is not None else None,
+            histogram_range=(row[dimension_count + 5], row[dimension_count + 6]) if row[dimension_count + 7] is not None else None
+        ), sorted(rows, key=lambda row: row[:dimension_count])))
+
+    def _get_array_value_stats_rows(self, variable: Variable, dimension_slice: Dict[Dimension, Union[int, slice, Sequence[int]]] = None):
+        # the rows the GROUP BY over the value table gives for table variables
+        location_ids = self._get_value_arrays()[variable.id][3]
+        value_stats = _ValueStatsAccumulator()
+        value_stats.add_array(VariableArray(variable=variable, array=self._read_value_array(variable, location_ids, list(map(
+            lambda dimension: range(dimension.size), variable.dimensions or []))), location_ids=location_ids, dimensions=variable.dimensions))
+        index_sets_by_dimension_id = dict(map(lambda item: (item[0].id, set(
+            _to_index_list(item[1], item[0].size))), (dimension_slice or {}).items()))
+        rows = []
+        for (_, dimension_items), (minimum, maximum, total, count, null_count, _) in value_stats.stats.items():
+            indices_by_dimension_id = dict(dimension_items)
+            # missing cells read as NaN, so only slices with values are kept
+            if count == 0 or any(map(lambda item: indices_by_dimension_id.get(item[0]) not in item[1], index_sets_by_dimension_id.items())):
+                continue
+            rows.append((*map(lambda dimension: indices_by_dimension_id[dimension.id], variable.dimensions or []),
+                         minimum, maximum, total / count, count, null_count, None, None, None))
+        return rows
+
+    def get_value_range(self, variable: Variable, dimension_slice: Dict[Dimension, Union[int, slice, Sequence[int]]] = None) -> Tuple[float, float]:
+        """`(min, max)` of `variable` over `dimension_slice`, e.g. for a colour
+        scale; read from the stats when the file has them."""
+        where, params = _build_value_where(variable, None, dimension_slice)
+        if _has_table(self.db_connection, 'value_stats'):
+            sql = f'SELECT MIN(min), MAX(max) FROM value_stats {where}'
+        elif variable.id in self._get_value_arrays():
+            array = self.get_values_array(
+                variable, dimension_slice=dimension_slice)
+            if np.isnan(array).all():
+                return (None, None)
+            return (float(np.nanmin(array)), float(np.nanmax(array)))
+        else:
+            value_sql = _get_value_sql(self._get_storage(variable))
+            sql = f'SELECT MIN({value_sql}), MAX({value_sql}) FROM value {where}'
+        db_cursor = self.db_connection.cursor()
+        db_cursor.execute(sql, params)
+        return tuple(db_cursor.fetchone())
+
+    def _get_value_table_layout(self):
+        db_cursor = self.db_connection.cursor()
+        db_cursor.execute('PRAGMA table_info(value)')
+        columns = db_cursor.fetchall()
+        primary_key_column_names = list(map(lambda column: column[1], sorted(
+            filter(lambda column: column[5] > 0, columns), key=lambda column: column[5])))
+        db_cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'value'")
+        without_rowid = 'WITHOUT ROWID' in db_cursor.fetchone()[0].upper()
+        db_cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'value_variable_dimension_location'")
+        has_indexes = db_cursor.fetchone() is not None
+        return primary_key_column_names, without_rowid, has_indexes
+
+    def _rebuild_value_table(self):
+        # the primary key of an existing table cannot be altered, so widening
+        # it to a newly added dimension means copying the value table once
+        _, without_rowid, has_indexes = self._get_value_table_layout()
+        if without_rowid:
+            raise ValueError(
+                'cannot add a dimension to the primary key of a WITHOUT ROWID value table')
+        column_names = ', '.join(['location', 'variable', *map(
+            lambda dimension: f'dimension_{dimension.id}', self.dimensions), 'value'])
+        _execute_sql(self.db_connection,
+                     'DROP INDEX IF EXISTS value_variable_dimension_location')
+        _execute_sql(self.db_connection,
+                     'ALTER TABLE value RENAME TO value_previous')
+        _create_value_table(self.db_connection, self.dimensions)
+        _execute_sql(self.db_connection,
+                     f'INSERT INTO value ({column_names}) SELECT {column_names} FROM value_previous')
+        _execute_sql(self.db_connection, 'DROP TABLE value_previous')
+        if has_indexes:
+            _create_value_indexes(self.db_connection, self.dimensions)
+
+    def add_dimension(self, dimension: Dimension):
+        """Add a dimension and its `dimension_<id>` column to the value table.
+
+        Existing values get NULL in the new column; the table is only copied
+        later if a variable spanning the new dimension is added.
+        """
+        if dimension.id in map(lambda dimension: dimension.id, self.dimensions):
+            raise ValueError(f'dimension {dimension.id} already exists')
+        with _transaction(self.db_connection):
+            _fill_dimension_table(self.db_connection, [dimension])
+            _execute_sql(self.db_connection,
+                         f'ALTER TABLE value ADD COLUMN dimension_{dimension.id} INTEGER')
+            for table_name in filter(lambda table_name: _has_table(self.db_connection, table_name), ['value_stats', 'value_pyramid', 'value_series']):
+                _execute_sql(self.db_connection,
+                             f'ALTER TABLE {table_name} ADD COLUMN dimension_{dimension.id} INTEGER')
+        self.dimensions.append(dimension)
+
+    def extend_dimension(self, dimension: Dimension, size: int, value_labels: Sequence[str] = None):
+        """Grow a dimension, e.g. to append new time steps with `add_values`."""
+        with _transaction(self.db_connection):
+            _execute_sql(self.db_connection, 'UPDATE dimension SET size = ?, value_labels = ? WHERE id = ?', [
+                         size, json.dumps(value_labels if value_labels is not None else dimension.value_labels), dimension.id])
+            if _has_table(self.db_connection, 'pyramid_level'):
+                _execute_sql(self.db_connection, 'UPDATE pyramid_level SET size = (? + factor - 1) / factor WHERE dimension = ?', [
+                             size, dimension.id])
+        for cached_dimension in filter(lambda cached_dimension: cached_dimension.id == dimension.id, self.dimensions):
+            cached_dimension.size = size
+            if value_labels is not None:
+                cached_dimension.value_labels = value_labels
+        dimension.size = size
+        if value_labels is not None:
+            dimension.value_labels = value_labels
+
+    def add_locations(self, locations: Iterable[Location], replace: bool = False,
+                      geometry_encoding: str = 'json', geometry_precision: int = 6):
+        """Add or replace locations; they are simplified for the database's
+        existing levels of detail and added to its spatial index as well."""
+        with _transaction(self.db_connection):
+            _fill_location_table(self.db_connection, locations, replace, geometry_encoding, geometry_precision,
+                                 self.lod_tolerances, _has_table(self.db_connection, 'location_rtree'))
+        self._locations = None
+
+    def add_variable(self, variable: Variable, values: Iterable[Union[Value, VariableArray]] = (), replace: bool = False):
+        """Add a variable with its values, or replace an existing one and all
+        of its values when `replace` is set."""
+        existing_variable = next(filter(
+            lambda existing_variable: existing_variable.id == variable.id, self.variables), None)
+        if existing_variable is not None and not replace:
+            raise ValueError(f'variable {variable.id} already exists')
+        known_dimension_ids = set(
+            map(lambda dimension: dimension.id, self.dimensions))
+        for dimension in variable.dimensions or []:
+            if dimension.id not in known_dimension_ids:
+                raise ValueError(
+                    f'dimension "{dimension.name}" has to be added before variable "{variable.name}"')
+        _validate_variable_storage(variable)
+        replaced_chunk_stores = []
+        with _transaction(self.db_connection):
+            primary_key_column_names, _, _ = self._get_value_table_layout()
+            if any(map(lambda dimension: f'dimension_{dimension.id}' not in primary_key_column_names, variable.dimensions or [])):
+                self._rebuild_value_table()
+            if existing_variable is not None:
+                _execute_sql(self.db_connection,
+                             'DELETE FROM value WHERE variable = ?', [variable.id])
+                # a replaced chunked variable is written to the value table
+                value_array = self._get_value_arrays().get(variable.id)
+                if value_array is not None:
+                    # files are not rolled back with the transaction, so they
+                    # are only removed once it has been committed
+                    if value_array[0] == 'npy_directory':
+                        replaced_chunk_stores.append(value_array[4])
+                    else:
+                        value_array[4].delete_variable(variable.id)
+                    _execute_sql(self.db_connection,
+                                 'DELETE FROM value_array WHERE variable = ?', [variable.id])
+                    self._value_arrays = None
+                _execute_sql(self.db_connection,
+                             'DELETE FROM variable_dimension WHERE variable = ?', [variable.id])
+                if _has_table(self.db_connection, 'variable_storage'):
+                    _execute_sql(self.db_connection,
+                                 'DELETE FROM variable_storage WHERE variable = ?', [variable.id])
+            _fill_variable_table(self.db_connection, [variable], replace)
+            _fill_variable_dimension_table(self.db_connection, [variable])
+            if variable.storage is not None:
+                _create_variable_storage_table(self.db_connection)
+                _fill_variable_storage_table(self.db_connection, [variable])
+            _fill_value_table(self.db_connection, values,
+                              WriterOptions(), commit=False, storages_by_variable_id={variable.id: variable.storage})
+            _refresh_derived_value_tables(self.db_connection, [variable])
+        for chunk_store in replaced_chunk_stores:
+            chunk_store.delete_variable(variable.id)
+        if existing_variable is not None:
+            self.variables.remove(existing_variable)
+        self.variables.append(variable)
+
+    def add_values(self, values: Iterable[Union[Value, VariableArray]], replace: bool = False, chunk_size: int = 100000):
+        """Insert values of existing variables, e.g. new time steps. With
+        `replace`, rows that already exist are overwritten."""
+        with _transaction(self.db_connection):
+            # only used to learn which variables' stats and pyramids went stale
+            value_stats = _ValueStatsAccumulator()
+            _fill_value_table(self.db_connection, values,
+                              WriterOptions(chunk_size=chunk_size), commit=False, or_replace=replace, accumulators=[value_stats],
+                              storages_by_variable_id=dict(map(lambda variable: (variable.id, variable.storage), self.variables)))
+            for variable in filter(lambda variable: variable.id in value_stats.variable_ids, self.variables):
+                if variable.id in self._get_value_arrays():
+                    raise ValueError(
+                        f'variable "{variable.name}" is stored as a chunked array, which cannot be changed in place; replace it with add_variable instead')
+            _refresh_derived_value_tables(self.db_connection, list(filter(
+                lambda variable: variable.id in value_stats.variable_ids, self.variables)))
+
+    def add_derived_variable(self, variable: Variable, expression: str, method: str = 'sql'):
+        """Compute `variable` from an expression over existing variables and
+        append it to the database in place.
+
+        `expression` refers to variables by name, e.g. `'STGW - SNO'`,
+        `'RFF * 0.001'` or `'Temp_av > 0'`. Every referenced variable must
+        have the same dimensions as `variable`. With `method='sql'` the
+        operands are joined by an `INSERT ... SELECT` inside SQLite; with
+        `method='numpy'` they are loaded as aligned arrays and evaluated in
+        NumPy. Cells where the result is missing are not written.
+        """
+        variables_by_name = dict(
+            map(lambda variable: (variable.name, variable), self.variables))
+        if variable.name in variables_by_name:
+            raise ValueError(f'variable "{variable.name}" already exists')
+        tree, operands = _parse_expression(expression, variables_by_name)
+        dimension_ids = list(
+            map(lambda dimension: dimension.id, variable.dimensions or []))
+        for operand in operands:
+            if sorted(map(lambda dimension: dimension.id, operand.dimensions)) != sorted(dimension_ids):
+                raise ValueError(
+                    f'variable "{operand.name}" does not have the same dimensions as "{variable.name}"')
+        if method == 'sql':
+            for operand in filter(lambda operand: operand.id in self._get_value_arrays(), operands):
+                raise ValueError(
+                    f'variable "{operand.name}" is stored as a chunked array, which only method "numpy" can read')
+        _validate_variable_storage(variable)
+        with _transaction(self.db_connection):
+            _fill_variable_table(self.db_connection, [variable])
+            _fill_variable_dimension_table(self.db_connection, [variable])
+            if variable.storage is not None:
+                _create_variable_storage_table(self.db_connection)
+                _fill_variable_storage_table(self.db_connection, [variable])
+            if method == 'sql':
+                aliases = dict(
+                    map(lambda item: (item[1].name, f'operand_{item[0]}'), enumerate(operands)))
+                dimension_column_names = list(
+                    map(lambda dimension_id: f'dimension_{dimension_id}', dimension_ids))
+                joins = []
+                join_params = []
+                for alias, operand in zip(list(aliases.values())[1:], operands[1:]):
+                    conditions = [f'{alias}.variable = ?',
+                                  f'{alias}.location = operand_0.location']
+                    conditions.extend(map(
+                        lambda name: f'{alias}.{name} = operand_0.{name}', dimension_column_names))
+                    joins.append(
+                        f'JOIN value {alias} ON {" AND ".join(conditions)}')
+                    join_params.append(operand.id)
+                expression_sql = _get_quantized_sql(variable.storage, _expression_to_sql(tree, dict(map(
+                    lambda item: (item[0].name, _get_value_sql(item[0].storage, f'{item[1]}.value')), zip(operands, aliases.values())))))
+                sql = f'''
+                    INSERT INTO value (location, variable, {''.join(map(lambda name: f'{name}, ', dimension_column_names))}value)
+                    SELECT * FROM (
+                        SELECT operand_0.location, ?, {''.join(map(lambda name: f'operand_0.{name}, ', dimension_column_names))}{expression_sql} AS derived_value
+                        FROM value operand_0
+                        {NEW_LINE_CHARACTER.join(joins)}
+                        WHERE operand_0.variable = ?
+                    ) WHERE derived_value IS NOT NULL
+                '''
+                _execute_sql(self.db_connection, sql, [
+                             variable.id, *join_params, operands[0].id])
+                _validate_packed_value_rows(self.db_connection, variable)
+            elif method == 'numpy':
+                location_ids = self.get_location_ids()
+                arrays = {}
+                for operand in operands:
+                    array = self.get_values_array(operand, location_ids)
+                    # align the operand's axes with the derived variable's
+                    operand_dimension_ids = list(
+                        map(lambda dimension: dimension.id, operand.dimensions))
+                    arrays[operand.name] = np.transpose(array, [0] + list(map(
+                        lambda dimension_id: operand_dimension_ids.index(dimension_id) + 1, dimension_ids)))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    result = np.asarray(_evaluate_expression(
+                        tree, arrays), dtype=float)
+                result[~np.isfinite(result)] = np.nan
+                if variable.storage is not None:
+                    result = _quantize(result, variable.storage)
+                variable_array = VariableArray(
+                    variable=variable, array=result, location_ids=location_ids, dimensions=variable.dimensions)
+                for row_dimension_ids, rows in _iter_variable_array_rows(variable_array, 100000, skip_null=True):
+                    _write_value_rows(self.db_connection, {
+                                      row_dimension_ids: rows})
+            else:
+                raise ValueError(f'unknown method "{method}"')
+            _refresh_derived_value_tables(self.db_connection, [variable])
+        self.variables.append(variable)
+
+    def export_arrays(self, directory: str, variables: Sequence[Variable] = None):
+        """Write each variable as a dense `<name>.npy` cube (locations by the
+        variable's dimensions, NaN where missing) with a `<name>.json` sidecar
+        describing its axes; the location ids are shared in
+        `location_ids.npy`. The cubes are filled through memory maps, so they
+        may be larger than RAM. `load_variable_arrays` maps them back in."""
+        os.makedirs(directory, exist_ok=True)
+        location_ids = np.asarray(self.get_location_ids(), dtype=np.int64)
+        np.save(os.path.join(directory, 'location_ids.npy'), location_ids)
+        for variable in variables or self.variables:
+            array = np.lib.format.open_memmap(os.path.join(directory, f'{variable.name}.npy'), mode='w+', dtype=np.float64, shape=(
+                location_ids.size, *map(lambda dimension: dimension.size, variable.dimensions or [])))
+            self.get_values_array(variable, location_ids, out=array)
+            array.flush()
+            del array
+            # the storage as in the file, so a rebuild from the cube packs it again
+            storage = self._get_storage(variable)
+            with open(os.path.join(directory, f'{variable.name}.json'), 'w') as file:
+                json.dump({
+                    'variable': {'id': variable.id, 'name': variable.name, 'unit': variable.unit, 'description': variable.description,
+                                 **({} if storage is None else {'storage': asdict(storage)})},
+                    'array': f'{variable.name}.npy',
+                    'location_ids': 'location_ids.npy',
+                    'dimensions': list(map(asdict, variable.dimensions or []))
+                }, file, indent=2)
+
+    def to_options(self) -> Options:
+        """Everything in the file, with the values loaded into a list. NULL
+        values come back as `None` from the `table` backend and are left out
+        by the chunked ones."""
+        return Options(info=self.info, locations=self.locations, dimensions=self.dimensions, variables=self.variables, values=list(self.iter_values()))
+
+
 def read_gwfvis_db(path: str):
-    db_connection = _open_database(path)
-    query_result = _query_db_table(
-        db_connection=db_connection, table_name='info')
-    info = list(map(lambda d: Info(
-        key=d['key'], value=d['value'], label=d['label']), query_result))
-
-    query_result = _query_db_table(
-        db_connection=db_connection, table_name='location')
-    locations = list(map(lambda d: Location(id=d['id'], geometry=json.loads(
-        d['geometry']), metadata=json.loads(d['metadata'])), query_result))
-
-    query_result = _query_db_table(
-        db_connection=db_connection, table_name='dimension')
-    dimensions = list(map(lambda d: Dimension(id=d['id'], name=d['name'], size=d['size'],
-                      description=d['description'], value_labels=json.loads(d['value_labels'])), query_result))
-
-    query_result = _query_db_table(
-        db_connection=db_connection, table_name='variable')
-    variables = list(map(lambda d: Variable(
-        id=d['id'], name=d['name'], unit=d['unit'], description=d['description'], dimensions=[]), query_result))
-
-    query_result = _query_db_table(
-        db_connection=db_connection, table_name='variable_dimension')
-    for q in query_result:
-        variable_id = q['variable']
-        dimension_id = q['dimension']
-        variable = next(
-            filter(lambda variable: variable.id == variable_id, variables), None)
-        dimension = next(
-            filter(lambda dimension: dimension.id == dimension_id, dimensions), None)
-        if (variable is not None and dimension is not None):
-            variable.dimensions.append(dimension)
-
-    query_result = _query_db_table(
-        db_connection=db_connection, table_name='value')
-    values = list(
-        map(
-            lambda value: Value(
-                location=next(filter(lambda location: location.id ==
-                              value['location'], locations), None),
-                variable=next(
-                    filter(lambda variable: variable.id == value['variable'], variables), None),
-                value=value['value'],
-                dimension_dict=dict(
-                    map(
-                        lambda key: (next(dimension for dimension in dimensions if dimension.id == int(
-                            key[10:])), value[key]),
-                        list(filter(lambda key: key.startswith(
-                            'dimension_'), value.keys()))
-                    )
-                )
-            ),
-            query_result
+    """`GwfVisDB.to_options` of the file at `path`."""
+    with GwfVisDB(path) as db:
+        return db.to_options()
+
+
+def export_gwfvis_db_arrays(path: str, directory: str):
+    with GwfVisDB(path) as db:
+        db.export_arrays(directory)
+
+
+def load_variable_arrays(directory: str) -> Dict[str, VariableArray]:
+    """Memory-map the cubes written by `GwfVisDB.export_arrays`, by variable
+    name. Slicing an `array` only reads the cells asked for, and the arrays
+    can be passed straight back to `generate_gwfvis_db` or `add_variable`,
+    which read memory-mapped arrays a slab of locations at a time."""
+    dimensions_by_id = {}
+    variable_arrays = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, file_name)) as file:
+            axes = json.load(file)
+        dimensions = list(map(lambda dimension: dimensions_by_id.setdefault(
+            dimension['id'], Dimension(**dimension)), axes['dimensions']))
+        storage = axes['variable'].get('storage')
+        variable = Variable(**{**axes['variable'], 'storage': None if storage is None else VariableStorage(**storage)},
+                            dimensions=dimensions)
+        variable_arrays[variable.name] = VariableArray(
+            variable=variable,
+            array=np.load(os.path.join(
+                directory, axes['array']), mmap_mode='r'),
+            location_ids=np.load(os.path.join(
+                directory, axes['location_ids']), mmap_mode='r'),
+            dimensions=dimensions
         )
+    return variable_arrays
+
+
+def map_location_ids(source_ids: Sequence[int], location_ids: Sequence[int]) -> LocationIdMapping:
+    source_ids = np.asarray(source_ids)
+    location_ids = np.asarray(location_ids)
+    source_order = np.argsort(source_ids, kind='stable')
+    sorted_source_ids = source_ids[source_order]
+    if sorted_source_ids.size == 0:
+        positions = np.zeros(location_ids.shape, dtype=int)
+        matched = np.zeros(location_ids.shape, dtype=bool)
+    else:
+        positions = np.minimum(np.searchsorted(
+            sorted_source_ids, location_ids), sorted_source_ids.size - 1)
+        matched = sorted_source_ids[positions] == location_ids
+    return LocationIdMapping(
+        source_indices=source_order[positions[matched]],
+        location_ids=location_ids[matched],
+        unmatched_location_ids=location_ids[~matched],
+        unmatched_source_ids=source_ids[~np.isin(source_ids, location_ids)]
     )
 
-    return Options(info=info, locations=locations, dimensions=dimensions, variables=variables, values=values)
+
+def add_variable_array(db_connection: sqlite3.Connection, variable_array: VariableArray, chunk_size: int = 100000):
+    # packing, checks and refreshes are those of GwfVisDB.add_values
+    GwfVisDB(db_connection).add_values([variable_array], chunk_size=chunk_size)
+
+
+def _validate_options(options: Options, writer_options: WriterOptions):
+    if writer_options.geometry_encoding not in GEOMETRY_ENCODINGS:
+        raise ValueError(
+            f'unknown geometry encoding "{writer_options.geometry_encoding}", expected one of {GEOMETRY_ENCODINGS}')
+    if writer_options.value_backend not in VALUE_BACKENDS:
+        raise ValueError(
+            f'unknown value backend "{writer_options.value_backend}", expected one of {VALUE_BACKENDS}')
+    for variable in options.variables:
+        _validate_variable_storage(variable)
+    variable_names = set(map(lambda variable: variable.name, options.variables))
+    for name in (writer_options.histogram_ranges or {}).keys():
+        if name not in variable_names:
+            raise ValueError(
+                f'histogram_ranges has a range for "{name}", which is not a variable')
+    if writer_options.without_rowid:
+        dimension_ids = set(
+            map(lambda dimension: dimension.id, options.dimensions))
+        for variable in options.variables:
+            if set(map(lambda dimension: dimension.id, variable.dimensions or [])) != dimension_ids:
+                raise ValueError(
+                    f'variable "{variable.name}" does not span every dimension, which WITHOUT ROWID requires')
+
+
+def _create_indexes(db_connection: sqlite3.Connection, options: Options, writer_options: WriterOptions):
+    if writer_options.create_indexes and not writer_options.without_rowid:
+        _create_value_indexes(db_connection, options.dimensions)
+    if writer_options.pyramid_factors:
+        _create_value_pyramid_indexes(db_connection, options.dimensions)
+    if writer_options.value_series:
+        _create_value_series_indexes(db_connection, options.dimensions)
+
+
+def generate_gwfvis_db(path: str, options: Options, writer_options: WriterOptions = None):
+    if writer_options is None:
+        writer_options = WriterOptions()
+    _validate_options(options, writer_options)
+    db_connection = _create_database(path)
+    _apply_build_pragmas(db_connection, writer_options)
+    _create_tables(db_connection, options.dimensions, writer_options)
+    _fill_tables(db_connection, options, writer_options)
+    _fill_value_tables(db_connection, options, writer_options,
+                       _get_location_ids(db_connection))
+    _create_indexes(db_connection, options, writer_options)
+    db_connection.commit()
+    _restore_pragmas(db_connection, writer_options)
+    db_connection.close()
+
+
+# tables whose rows belong to one variable, and so to exactly one shard
+_SHARD_TABLE_NAMES = ['value', 'value_stats', 'value_pyramid',
+                      'value_series', 'value_chunk', 'value_array']
+
+
+def _split_variables(variables: Sequence[Variable], shard_count: int) -> Sequence[Sequence[Variable]]:
+    # the largest variables first, each onto the shard with the fewest cells
+    shards = list(map(lambda _: [], range(shard_count)))
+    shard_cells = [0] * shard_count
+    for variable in sorted(variables, key=lambda variable: -int(np.prod(list(map(lambda dimension: dimension.size, variable.dimensions or []))))):
+        shard = int(np.argmin(shard_cells))
+        shards[shard].append(variable)
+        shard_cells[shard] += int(np.prod(list(
+            map(lambda dimension: dimension.size, variable.dimensions or []))))
+    return list(filter(lambda shard: len(shard) > 0, shards))
 
 
-def generate_gwfvis_db(path: str, options: Options):
+def _build_value_shard(path: str, dimensions: Sequence[Dimension], variables: Sequence[Variable],
+                       get_values: Callable[[Sequence[Variable]], Iterable[Union[Value, VariableArray]]],
+                       writer_options: WriterOptions, location_ids: Sequence[int]):
+    # runs in a worker process; the shard gets the same tables as the main
+    # file, but only the value ones are filled and no indexes are built
+    db_connection = _create_database(path)
+    _apply_build_pragmas(db_connection, writer_options)
+    _create_tables(db_connection, dimensions, writer_options)
+    _fill_value_tables(db_connection, Options(info=[], locations=[], dimensions=dimensions, variables=variables,
+                                              values=get_values(variables)), writer_options, location_ids)
+    db_connection.commit()
+    db_connection.close()
+    return path
+
+
+def _merge_value_shard(db_connection: sqlite3.Connection, shard_path: str, value_backend: str):
+    # ATTACH is not allowed inside a transaction
+    db_connection.commit()
+    _execute_sql(db_connection, 'ATTACH DATABASE ? AS shard', [shard_path])
+    try:
+        with _transaction(db_connection):
+            for table_name in filter(lambda table_name: _has_table(db_connection, table_name), _SHARD_TABLE_NAMES):
+                if table_name == 'value_array':
+                    _execute_sql(db_connection, 'INSERT INTO main.value_array SELECT variable, backend, shape, chunk_shape, location_ids, ? FROM shard.value_array', [
+                                 _get_value_array_path(db_connection, value_backend)])
+                else:
+                    _execute_sql(
+                        db_connection, f'INSERT INTO main.{table_name} SELECT * FROM shard.{table_name}')
+    finally:
+        _execute_sql(db_connection, 'DETACH DATABASE shard')
+    if value_backend == 'npy_directory':
+        shard_directory = f'{shard_path}.chunks'
+        directory = os.path.join(os.path.dirname(_get_database_path(
+            db_connection)), _get_value_array_path(db_connection, value_backend))
+        for name in os.listdir(shard_directory):
+            shutil.move(os.path.join(shard_directory, name),
+                        os.path.join(directory, name))
+
+
+def generate_gwfvis_db_in_parallel(path: str, options: Options, get_values: Callable[[Sequence[Variable]], Iterable[Union[Value, VariableArray]]],
+                                   writer_options: WriterOptions = None, max_workers: int = None):
+    """Like `generate_gwfvis_db`, with the values written by `max_workers`
+    processes (the CPU count by default) into temporary shard databases,
+    one shard per group of variables, that are merged into `path` with
+    `ATTACH` and `INSERT ... SELECT` as they finish. The indexes are built
+    once, after the last merge.
+
+    `options.values` is not used: each worker calls `get_values` with the
+    variables of its shard and writes what it yields, so `get_values` has to
+    be picklable (e.g. a module level function) and only yield values of
+    those variables. A variable is never split across shards.
+    """
+    if writer_options is None:
+        writer_options = WriterOptions()
+    _validate_options(options, writer_options)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
     db_connection = _create_database(path)
-    _create_tables(db_connection, options.dimensions)
-    _fill_tables(db_connection, options)
+    _apply_build_pragmas(db_connection, writer_options)
+    _create_tables(db_connection, options.dimensions, writer_options)
+    _fill_tables(db_connection, options, writer_options)
+    if writer_options.value_backend != 'table':
+        _get_chunk_store(db_connection, writer_options.value_backend, _get_value_array_path(
+            db_connection, writer_options.value_backend)).create()
+    location_ids = _get_location_ids(db_connection)
+    # next to the output, so that chunk directories are moved, not copied
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as shard_directory:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = list(map(lambda item: executor.submit(_build_value_shard, os.path.join(shard_directory, f'shard_{item[0]}.gwfvisdb'),
+                                                            options.dimensions, item[1], get_values, writer_options, location_ids),
+                               enumerate(_split_variables(options.variables, max_workers))))
+            for future in as_completed(futures):
+                _merge_value_shard(db_connection, future.result(),
+                                   writer_options.value_backend)
+    _create_indexes(db_connection, options, writer_options)
     db_connection.commit()
+    _restore_pragmas(db_connection, writer_options)
+    db_connection.close()
 
 
 def clone_gwfvis_db(source_path: str, destination_path: str):
@@ -347,6 +2804,21 @@ def clone_gwfvis_db(source_path: str, destination_path: str):
     destination_db_connection = _create_database(destination_path)
     source_db_connection.backup(destination_db_connection)
     source_db_connection.close()
+    # chunk directories live next to the file, so they are copied alongside
+    if _has_table(destination_db_connection, 'value_array'):
+        db_cursor = destination_db_connection.cursor()
+        db_cursor.execute(
+            "SELECT DISTINCT path FROM value_array WHERE backend = 'npy_directory'")
+        for (path,) in db_cursor.fetchall():
+            destination_path_in_db = f'{os.path.basename(destination_path)}.chunks'
+            destination_directory = os.path.join(
+                os.path.dirname(destination_path), destination_path_in_db)
+            shutil.rmtree(destination_directory, ignore_errors=True)
+            shutil.copytree(os.path.join(os.path.dirname(
+                source_path), path), destination_directory)
+            _execute_sql(destination_db_connection, 'UPDATE value_array SET path = ? WHERE path = ?', [
+                         destination_path_in_db, path])
+        destination_db_connection.commit()
     return destination_db_connection
 
 
@@ -1,16 +1,23 @@
 # %% imports
 from typing import Sequence
-import shapefile
-import netCDF4 as nc
-from gwfvis_db import Dimension, Location, Options, Value, Variable, generate_gwfvis_db, Info
+from gwfvis_db import Dimension, Options, Variable, VariableArray, WriterOptions, generate_gwfvis_db, Info, map_location_ids
+from netcdf_source import NetCDFSource, read_variables_in_parallel
+from shapefile_source import ShapefileSource
 
 # %% configs
 # TODO modify the configs if needed
 db_path = 'output/mesh.gwfvisdb'
 nc_db_file_path = 'data/mesh/Drainage_database/BowBanff_MESH_drainage_database.nc'
 shape_file_path = 'data/mesh/Shape/bow_distributed.shp'
+# simplified geometry levels in the shapefile's coordinate units (degrees)
+lod_tolerances = [0.0005, 0.002, 0.01]
+# the state files are monthly, so 12 adds yearly means
+pyramid_factors = [12]
+# clicking a subbasin reads its whole series from one value_series row
+value_series = True
 
 layers = [1, 2, 3]
+max_workers = None  # number of processes reading MESH state files, defaults to the CPU count
 nc_file_base_path = 'data/mesh/MESH_state'
 nc_file_path_and_variable_name_pairs = [
     [f'{nc_file_base_path}/STGW_M_GRD.nc', 'STGW',
@@ -35,99 +42,103 @@ nc_file_path_and_variable_name_pairs = [
         'RFF', 'Total runoff [mm]', 'mm', False],
 ]
 
-# %% getting ready
-nc_file_path = nc_file_path_and_variable_name_pairs[0][0]
+# %% main function
+# everything that reads data runs here, so that the worker processes spawned by
+# read_variables_in_parallel only import the configs
+def main():
+    # getting ready
+    nc_file_path = nc_file_path_and_variable_name_pairs[0][0]
 
-reader = shapefile.Reader(shape_file_path)
-nc_db = nc.Dataset(nc_db_file_path)
-dataset = nc.Dataset(nc_file_path)
+    source = ShapefileSource(shape_file_path, id_field='COMID')
+    nc_db = NetCDFSource(nc_db_file_path)
+    dataset = NetCDFSource(nc_file_path)
 
-# %% info
-info = [
-    Info(key='name', value='mesh', label='Name'),
-    Info(key='description', value='something...', label='Description')
-]
+    # info
+    info = [
+        Info(key='name', value='mesh', label='Name'),
+        Info(key='description', value='something...', label='Description')
+    ]
 
-# %% locations
-ids = list(nc_db.variables['seg_id'][:])
-locations: Sequence[Location] = []
-for shape_record in reader.shapeRecords():
-    id = int(shape_record.record['COMID'])
-    geometry = shape_record.shape.__geo_interface__
-    fields = reader.fields[1:]
-    field_names = [field[0] for field in fields]
-    metadata = dict(zip(field_names, shape_record.record))
-    locations.append(
-        Location(id=id, geometry=geometry, metadata=metadata)
-    )
-
-# %% dimensions
-time_size = dataset.dimensions['time'].size
-layer_size = len(layers)
-dimension_time = Dimension(id=0, name='time', size=time_size)
-dimension_layer = Dimension(id=1, name='layer', size=layer_size,
-                            description=None, value_labels=['1', '2', '3'])
-dimensions = [
-    dimension_time,
-    dimension_layer
-]
+    # locations
+    ids = list(nc_db.variables['seg_id'][:])
+    # streamed into the writer, one shape at a time
+    locations = source.iter_locations()
+
+    # dimensions
+    time_size = dataset.dimensions['time'].size
+    layer_size = len(layers)
+    dimension_time = Dimension(id=0, name='time', size=time_size)
+    dimension_layer = Dimension(id=1, name='layer', size=layer_size,
+                                description=None, value_labels=['1', '2', '3'])
+    dimensions = [
+        dimension_time,
+        dimension_layer
+    ]
+
+    # variables
+    variables: Sequence[Variable] = []
+    variable_and_nc_file_path_dict = {}
+    for i in range(len(nc_file_path_and_variable_name_pairs)):
+        [nc_file_path, variable_name, description, unit,
+            has_layers] = nc_file_path_and_variable_name_pairs[i]
+        dimensions_for_the_variable = [dimension_time]
+        if has_layers:
+            dimensions_for_the_variable.append(dimension_layer)
+        variable = Variable(
+            id=i,
+            name=variable_name,
+            dimensions=dimensions_for_the_variable,
+            unit=unit,
+            description=description
+        )
+        variables.append(variable)
+        variable_and_nc_file_path_dict[variable] = nc_file_path
 
-# %% variables
-variables: Sequence[Variable] = []
-variable_and_nc_file_path_dict = {}
-for i in range(len(nc_file_path_and_variable_name_pairs)):
-    [nc_file_path, variable_name, description, unit,
-        has_layers] = nc_file_path_and_variable_name_pairs[i]
-    dimensions_for_the_variable = [dimension_time]
-    if has_layers:
-        dimensions_for_the_variable.append(dimension_layer)
-    variable = Variable(
-        id=i,
-        name=variable_name,
-        dimensions=dimensions_for_the_variable,
-        unit=unit,
-        description=description
-    )
-    variables.append(variable)
-    variable_and_nc_file_path_dict[variable] = nc_file_path
-
-# %% values
-values: Sequence[Value] = []
-
-
-def set_value(locations, variable, layer=None):
-    current_variable = dataset.variables[variable.name]
-    for time in range(dimension_time.size):
-        for location in locations:
-            location_index = ids.index(location.id)
-            dimension_dict = {dimension_time: time}
+    # values
+    location_id_mapping = map_location_ids(ids, source.get_location_ids())
+    if location_id_mapping.unmatched_location_ids.size > 0:
+        print(f'{location_id_mapping.unmatched_location_ids.size} locations are not in the drainage database and get no values: {location_id_mapping.unmatched_location_ids.tolist()}')
+
+    # one task per file (and per layer file), each read as a whole time x location slice
+    read_tasks = []
+    for variable in variables:
+        nc_file_path = variable_and_nc_file_path_dict[variable]
+        if len(list(filter(lambda d: d.name == 'layer', variable.dimensions))) > 0:
+            for layer in layers:
+                read_tasks.append(((variable, layer - 1), nc_file_path.replace(
+                    '$$layer$$', str(layer)), variable.name, (slice(None), slice(None), 0)))
+        else:
+            read_tasks.append(((variable, None), nc_file_path,
+                              variable.name, (slice(None), slice(None), 0)))
+
+    def values_generator():
+        for (variable, layer), array in read_variables_in_parallel(read_tasks, max_workers):
+            dimension_dict = None
             if layer is not None:
-                dimension_dict[dimension_layer] = layer
-            values.append(Value(
-                location=location,
+                dimension_dict = {dimension_layer: layer}
+            yield VariableArray(
                 variable=variable,
-                value=float(current_variable[time][location_index][0]),
+                array=array[:, location_id_mapping.source_indices],
+                location_ids=location_id_mapping.location_ids,
+                dimensions=[dimension_time],
+                location_axis=1,
                 dimension_dict=dimension_dict
-            ))
+            )
 
+    values = values_generator()
 
-for variable in variables:
-    nc_file_path = variable_and_nc_file_path_dict[variable]
-    if len(list(filter(lambda d: d.name == 'layer', variable.dimensions))) > 0:
-        for layer in layers:
-            dataset = nc.Dataset(nc_file_path.replace('$$layer$$', str(layer)))
-            set_value(locations, variable, layer=layer - 1)
-    else:
-        dataset = nc.Dataset(nc_file_path)
-        set_value(locations, variable)
+    # writing
+    generate_gwfvis_db(db_path, Options(
+        info=info,
+        locations=locations,
+        dimensions=dimensions,
+        variables=variables,
+        values=values
+    ), WriterOptions(
+        lod_tolerances=lod_tolerances, pyramid_factors=pyramid_factors, value_series=value_series))
 
-# %% main function
-generate_gwfvis_db(db_path, Options(
-    info=info,
-    locations=locations,
-    dimensions=dimensions,
-    variables=variables,
-    values=values
-))
+
+if __name__ == '__main__':
+    main()
 
 # %% finished
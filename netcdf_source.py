@@ -0,0 +1,384 @@
+# %% imports
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import itertools
+import os
+from typing import Any, Hashable, Iterator, Sequence, Tuple
+import netCDF4 as nc
+import numpy as np
+from gwfvis_db import Location
+
+# %% data structures
+
+
+class NetCDFSource:
+    """A netCDF file read in chunk-aligned slabs.
+
+    Every variable is read in slabs that line up with its on-disk chunks (for
+    contiguous variables, in whole rows) and span as many trailing axes as fit
+    in `slab_size`. Decoded slabs are kept in an LRU cache of up to
+    `cache_size` bytes shared by all variables of the file, so element-wise
+    access such as `source.variables['x'][i][j]` decompresses every chunk at
+    most once while it stays cached. The HDF5 chunk cache of each variable is
+    sized to `chunk_cache_size`.
+    """
+
+    def __init__(self, path: str, slab_size: int = 16 * 1024 * 1024, cache_size: int = 256 * 1024 * 1024, chunk_cache_size: int = 64 * 1024 * 1024):
+        self.path = path
+        self.dataset = nc.Dataset(path)
+        self.slab_size = slab_size
+        self.cache_size = cache_size
+        self.chunk_cache_size = chunk_cache_size
+        self.variables = _SourceVariables(self)
+        self._slab_cache = OrderedDict()
+        self._cached_bytes = 0
+
+    @property
+    def dimensions(self):
+        return self.dataset.dimensions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._slab_cache.clear()
+        self._cached_bytes = 0
+        self.dataset.close()
+
+    def _get_cached_slab(self, key):
+        slab = self._slab_cache.get(key)
+        if slab is not None:
+            self._slab_cache.move_to_end(key)
+        return slab
+
+    def _cache_slab(self, key, slab):
+        self._slab_cache[key] = slab
+        self._cached_bytes += slab.nbytes
+        while self._cached_bytes > self.cache_size and len(self._slab_cache) > 1:
+            _, evicted_slab = self._slab_cache.popitem(last=False)
+            self._cached_bytes -= evicted_slab.nbytes
+
+
+class _SourceVariables:
+    def __init__(self, source: NetCDFSource):
+        self._source = source
+        self._variables = {}
+
+    def __getitem__(self, name: str):
+        variable = self._variables.get(name)
+        if variable is None:
+            variable = self._variables[name] = SourceVariable(
+                self._source, self._source.dataset.variables[name])
+        return variable
+
+    def __contains__(self, name: str):
+        return name in self._source.dataset.variables
+
+    def keys(self):
+        return self._source.dataset.variables.keys()
+
+
+class SourceVariable:
+    def __init__(self, source: NetCDFSource, variable: nc.Variable):
+        self._source = source
+        self.variable = variable
+        self.name = variable.name
+        self.shape = variable.shape
+        self.dimensions = variable.dimensions
+        self.dtype = variable.dtype
+        chunking = variable.chunking()
+        self.chunk_shape = tuple(
+            [1] * len(self.shape) if chunking == 'contiguous' or chunking is None else chunking)
+        if chunking != 'contiguous' and len(self.shape) > 0:
+            variable.set_var_chunk_cache(size=source.chunk_cache_size)
+        self.slab_shape = _get_slab_shape(
+            self.shape, self.chunk_shape, np.dtype(self.dtype).itemsize, source.slab_size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_slab(self, slab_index: Tuple[int, ...]):
+        key = (self.name, slab_index)
+        slab = self._source._get_cached_slab(key)
+        if slab is None:
+            slab = np.ma.asarray(self.variable[tuple(map(lambda item: slice(
+                item[0] * item[1], (item[0] + 1) * item[1]), zip(slab_index, self.slab_shape)))])
+            slab.flags.writeable = False
+            self._source._cache_slab(key, slab)
+        return slab
+
+    def iter_slabs(self) -> Iterator[Tuple[Tuple[slice, ...], np.ndarray]]:
+        """Yield `(index, array)` for every slab in on-disk order."""
+        slab_counts = list(map(lambda item: -(-item[0] // item[1]),
+                           zip(self.shape, self.slab_shape)))
+        for slab_index in itertools.product(*map(range, slab_counts)):
+            yield tuple(map(lambda item: slice(item[0] * item[1], min((item[0] + 1) * item[1], item[2])), zip(slab_index, self.slab_shape, self.shape))), self._read_slab(slab_index)
+
+    def __getitem__(self, index):
+        if len(self.shape) == 0:
+            return self.variable[index]
+        # basic indexing inside a single slab returns a read-only view of it
+        slab_index_and_local_index = _get_single_slab_index(
+            index, self.shape, self.slab_shape)
+        if slab_index_and_local_index is not None:
+            slab_index, local_index = slab_index_and_local_index
+            result = self._read_slab(slab_index)[local_index]
+            if isinstance(result, np.ma.MaskedArray) and not np.ma.is_masked(result):
+                return result.data
+            return result
+        axis_indices, integer_axes = _normalize_index(index, self.shape)
+        result = np.ma.masked_all(
+            tuple(map(len, axis_indices)), dtype=self.dtype)
+        # per axis, the slabs touched and where their cells go in the result
+        axis_slab_selections = []
+        for indices, slab_length in zip(axis_indices, self.slab_shape):
+            slab_numbers = indices // slab_length
+            axis_slab_selections.append(list(map(lambda slab_number: (slab_number, np.flatnonzero(
+                slab_numbers == slab_number)), np.unique(slab_numbers))))
+        for selections in itertools.product(*axis_slab_selections):
+            slab = self._read_slab(
+                tuple(map(lambda selection: int(selection[0]), selections)))
+            result_positions = list(
+                map(lambda selection: selection[1], selections))
+            slab_positions = list(map(lambda item: item[0][item[1]] - item[2][0] * item[3], zip(
+                axis_indices, result_positions, selections, self.slab_shape)))
+            result[np.ix_(*result_positions)] = slab[np.ix_(*slab_positions)]
+        if len(integer_axes) > 0:
+            result = result.reshape(tuple(map(lambda item: item[1], filter(
+                lambda item: item[0] not in integer_axes, enumerate(result.shape)))))
+        if result.ndim == 0:
+            return result[()]
+        if not np.ma.is_masked(result):
+            return result.filled()
+        return result
+
+
+# %% helpers
+
+
+def _get_slab_shape(shape: Sequence[int], chunk_shape: Sequence[int], itemsize: int, slab_size: int):
+    # start from one chunk and widen axes from the last one backwards: whole
+    # axes while they fit, then as many chunks of the next axis as fit
+    slab_shape = list(chunk_shape)
+    for axis in reversed(range(len(shape))):
+        whole_axis = slab_shape[:axis] + [shape[axis]] + slab_shape[axis + 1:]
+        if int(np.prod(whole_axis)) * itemsize <= slab_size:
+            slab_shape = whole_axis
+            continue
+        other_bytes = int(np.prod(slab_shape)) // slab_shape[axis] * itemsize
+        chunk_count = max(slab_size // max(other_bytes *
+                          chunk_shape[axis], 1), 1)
+        slab_shape[axis] = min(chunk_count * chunk_shape[axis], shape[axis])
+        break
+    return tuple(map(lambda length: max(int(length), 1), slab_shape))
+
+
+def _get_single_slab_index(index, shape: Sequence[int], slab_shape: Sequence[int]):
+    if not isinstance(index, tuple):
+        index = (index,)
+    if len(index) > len(shape):
+        return None
+    slab_index = []
+    local_index = []
+    for axis, length in enumerate(shape):
+        item = index[axis] if axis < len(index) else slice(None)
+        slab_length = slab_shape[axis]
+        if isinstance(item, (int, np.integer)):
+            if item < -length or item >= length:
+                return None
+            item = int(item) % length
+            slab_index.append(item // slab_length)
+            local_index.append(item - slab_index[-1] * slab_length)
+        elif isinstance(item, slice):
+            start, stop, step = item.indices(length)
+            if step != 1 or stop <= start:
+                return None
+            if start // slab_length != (stop - 1) // slab_length:
+                return None
+            slab_index.append(start // slab_length)
+            local_index.append(slice(start - slab_index[-1] * slab_length,
+                               stop - slab_index[-1] * slab_length))
+        else:
+            return None
+    return tuple(slab_index), tuple(local_index)
+
+
+def _normalize_index(index, shape: Sequence[int]):
+    if not isinstance(index, tuple):
+        index = (index,)
+    if any(map(lambda item: item is Ellipsis, index)):
+        position = next(filter(lambda item: item[1] is Ellipsis, enumerate(index)))[0]
+        index = index[:position] + (slice(None),) * \
+            (len(shape) - len(index) + 1) + index[position + 1:]
+    index = index + (slice(None),) * (len(shape) - len(index))
+    if len(index) > len(shape):
+        raise IndexError(
+            f'too many indices for a variable with {len(shape)} dimensions')
+    axis_indices = []
+    integer_axes = []
+    for axis, (item, length) in enumerate(zip(index, shape)):
+        if isinstance(item, slice):
+            axis_indices.append(np.arange(*item.indices(length)))
+        elif isinstance(item, (int, np.integer)):
+            if item < -length or item >= length:
+                raise IndexError(
+                    f'index {item} is out of bounds for axis {axis} with size {length}')
+            axis_indices.append(np.array([item % length]))
+            integer_axes.append(axis)
+        else:
+            item = np.asarray(item)
+            if item.dtype == bool:
+                # a mask picks the positions where it is set, as in netCDF4
+                if item.shape != (length,):
+                    raise IndexError(
+                        f'boolean index of shape {item.shape} does not match axis {axis} with size {length}')
+                axis_indices.append(np.flatnonzero(item))
+                continue
+            item = item.astype(int)
+            if ((item < -length) | (item >= length)).any():
+                raise IndexError(
+                    f'index {item[(item < -length) | (item >= length)][0]} is out of bounds for axis {axis} with size {length}')
+            axis_indices.append(item % length)
+    return axis_indices, integer_axes
+
+
+def _read_variable(path: str, variable_name: str, index: Any = None):
+    with NetCDFSource(path) as source:
+        variable = source.variables[variable_name]
+        array = variable[:] if index is None else variable[index]
+    return np.ma.filled(np.ma.asarray(array, dtype=float), np.nan)
+
+
+_COARSEN_METHODS = ['mean', 'nanmean', 'min', 'max', 'nanmin', 'nanmax']
+
+
+def _pad_axis(array: np.ndarray, axis: int, before: int, length: int, pad_value: float):
+    # pad `before` cells at the start of `axis`, then pad or trim it to `length`
+    pad_width = [(0, 0)] * array.ndim
+    pad_width[axis] = (before, max(length - before - array.shape[axis], 0))
+    padded = np.pad(array, pad_width, constant_values=pad_value)
+    return np.take(padded, np.arange(length), axis=axis)
+
+
+# %% exported functions
+
+def coarsen(array, factors: Tuple[int, int], method: str = 'mean', shape: Tuple[int, int] = None, offsets: Tuple[int, int] = (0, 0), fill_value: float = None) -> np.ndarray:
+    """Reduce the last two axes of `array` by block aggregation.
+
+    Output cell `i` along an axis aggregates source cells
+    `[i * factor - offset, (i + 1) * factor - offset)`, clipped to the array;
+    an offset of `factor // 2` centres the blocks on `i * factor`. `shape`
+    defaults to `(n // factor)` cells per axis. Masked cells, NaN and cells
+    equal to `fill_value` are missing: `mean`, `min` and `max` return NaN for
+    blocks containing any, the `nan*` methods ignore them.
+    """
+    if method not in _COARSEN_METHODS:
+        raise ValueError(
+            f'unknown method "{method}", expected one of {_COARSEN_METHODS}')
+    data = np.ma.filled(np.ma.asarray(array, dtype=float), np.nan)
+    if fill_value is not None:
+        data = np.where(data == fill_value, np.nan, data)
+    inside = np.ones(data.shape[-2:], dtype=float)
+    if shape is None:
+        shape = (data.shape[-2] // factors[0], data.shape[-1] // factors[1])
+    if method in ['mean', 'nanmean']:
+        pad_value = 0
+    elif method in ['min', 'nanmin']:
+        pad_value = np.inf
+    else:
+        pad_value = -np.inf
+    for axis, factor, count, offset in zip([-2, -1], factors, shape, offsets):
+        data = _pad_axis(data, axis, offset, count * factor, pad_value)
+        inside = _pad_axis(inside, axis, offset, count * factor, 0)
+    blocks = data.reshape(
+        data.shape[:-2] + (shape[0], factors[0], shape[1], factors[1]))
+    inside_blocks = inside.reshape(
+        (shape[0], factors[0], shape[1], factors[1]))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'mean':
+            return blocks.sum(axis=(-3, -1)) / inside_blocks.sum(axis=(-3, -1))
+        if method == 'nanmean':
+            valid = ~np.isnan(blocks) & (inside_blocks > 0)
+            return np.nansum(blocks, axis=(-3, -1)) / valid.sum(axis=(-3, -1))
+        if method == 'min':
+            return blocks.min(axis=(-3, -1))
+        if method == 'max':
+            return blocks.max(axis=(-3, -1))
+        reduced = np.fmin.reduce(blocks, axis=(-3, -1)) if method == 'nanmin' else np.fmax.reduce(
+            blocks, axis=(-3, -1))
+        return np.where(np.isinf(reduced), np.nan, reduced)
+
+
+def iter_ugrid_triangle_locations(source: NetCDFSource, face_count: int = None, id_variable_name: str = 'global_id', chunk_size: int = 100000) -> Iterator[Location]:
+    """Yield one triangle `Location` per face of a UGRID mesh.
+
+    The node coordinates are loaded once; faces are processed `chunk_size` at a
+    time by gathering the coordinates of all their nodes with fancy indexing.
+    All faces are read unless `face_count` is given. Node numbers honour the
+    `start_index` attribute of `Mesh2_face_nodes`.
+    """
+    node_xs = np.asarray(source.variables['Mesh2_node_x'][:], dtype=float)
+    node_ys = np.asarray(source.variables['Mesh2_node_y'][:], dtype=float)
+    face_nodes_variable = source.variables['Mesh2_face_nodes']
+    start_index = int(
+        getattr(face_nodes_variable.variable, 'start_index', 0))
+    if face_count is None:
+        face_count = face_nodes_variable.shape[0]
+    for start in range(0, face_count, chunk_size):
+        stop = min(start + chunk_size, face_count)
+        ids = np.asarray(
+            source.variables[id_variable_name][start:stop]).astype(int).tolist()
+        face_nodes = np.asarray(
+            face_nodes_variable[start:stop, 0:3]).astype(int)
+        node_indices = face_nodes - start_index
+        coordinates = np.stack(
+            [node_xs[node_indices], node_ys[node_indices]], axis=-1).tolist()
+        face_node_labels = list(map(lambda nodes: f'{nodes[0]}, {nodes[1]}, {nodes[2]}',
+                                    face_nodes.tolist()))
+        for id, triangle, face_node_label in zip(ids, coordinates, face_node_labels):
+            yield Location(
+                id=id,
+                geometry={
+                    'type': 'Polygon',
+                    'coordinates': [triangle]
+                },
+                metadata={
+                    'global_id': id,
+                    'Mesh2_face_nodes': face_node_label
+                }
+            )
+
+
+def read_variables_in_parallel(tasks: Sequence[Tuple[Hashable, str, str, Any]], max_workers: int = None) -> Iterator[Tuple[Hashable, np.ndarray]]:
+    """Read whole netCDF variables (or slices of them) in a process pool.
+
+    Each task is `(key, path, variable_name, index)`; `index` is applied to
+    the variable in one read (e.g. `(slice(None), slice(None), 0)`) or the
+    whole variable is read when it is `None`. `(key, array)` pairs are yielded
+    in the calling process as the reads complete, so a single consumer can
+    write them while the pool keeps reading. At most two reads per worker are
+    in flight to keep memory bounded. Masked cells are returned as NaN.
+
+    Scripts using this must guard their entry point with
+    `if __name__ == '__main__':` on platforms that spawn worker processes.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    pending_tasks = list(tasks)
+    pending_tasks.reverse()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        while len(pending_tasks) > 0 or len(in_flight) > 0:
+            while len(pending_tasks) > 0 and len(in_flight) < max_workers * 2:
+                key, path, variable_name, index = pending_tasks.pop()
+                in_flight[executor.submit(
+                    _read_variable, path, variable_name, index)] = key
+            done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future.result()
+
+
+# %%
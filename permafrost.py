@@ -1,19 +1,23 @@
 # %% imports
-import netCDF4 as nc
 import numpy as np
 import itertools
 import json
 from tqdm import tqdm
-from gwfvis_db import Dimension, Location, Options, Value, Variable, generate_gwfvis_db, Info
+from gwfvis_db import Dimension, Location, Options, Variable, VariableArray, WriterOptions, generate_gwfvis_db, Info
+from netcdf_source import NetCDFSource, coarsen
 
 # %% configs
 # TODO modify the configs if needed
 db_path = 'output/permafrost.gwfvisdb'
 nc_file_path = 'data/permafrost/Tmin_max_spinning.nc'
 replace_invalid_values_with_null = True
+aggregation_method = 'mean'  # one of mean, nanmean, min, max, nanmin, nanmax
+# table, or sqlite_chunks / npy_directory to store the dense cycle x gru x
+# level x time cube as chunked arrays (read back through GwfVisDB)
+value_backend = 'table'
 
 # %% getting ready
-dataset = nc.Dataset(nc_file_path)
+dataset = NetCDFSource(nc_file_path)
 lats = dataset.variables['lat'][:]
 lons = dataset.variables['lon'][:]
 
@@ -87,43 +91,37 @@ variables = [
 ]
 
 # %% values
+location_ids = [location.id for location in locations]
+
+
 def values_generator():
-    for location in tqdm(locations):
-        for variable in variables:
-            dimension_value_ranges = []
-            for dimension in variable.dimensions:
-                dimension_value_ranges.append(range(dimension.size))
-            dimension_indices_combinations = itertools.product(
-                *dimension_value_ranges)
-            dimension_dicts = list(map(lambda dimension_indices_combination: dict(map(lambda index_and_dimension: (
-                index_and_dimension[1], dimension_indices_combination[index_and_dimension[0]]), enumerate(dimensions))), dimension_indices_combinations))
-            for dimension_dict in dimension_dicts:
-                dimension_cycle_index = dimension_dict[dimension_cycle]
-                dimension_gru_index = dimension_dict[dimension_gru]
-                dimension_level_index = dimension_dict[dimension_level]
-                dimension_time_index = dimension_dict[dimension_time]
-                lat_index = int(location.id / lon_count)
-                lon_index = location.id % lon_count
-                lat_index_range = [
-                    max(round(lat_index * lat_count_reduced_by - lat_count_reduced_by / 2), 0),
-                    min(round(lat_index * lat_count_reduced_by + lat_count_reduced_by / 2), len(lats))
-                ]
-                lon_index_range = [
-                    max(round(lon_index * lon_count_reduced_by - lon_count_reduced_by / 2), 0),
-                    min(round(lon_index * lon_count_reduced_by + lon_count_reduced_by / 2), len(lons))
-                ]
-                value = float(np.array(dataset.variables[variable.name][
-                    dimension_cycle_index,
-                    dimension_gru_index, 
-                    dimension_level_index, 
-                    dimension_time_index, 
-                    lat_index_range[0]:lat_index_range[1], 
-                    lon_index_range[0]:lon_index_range[1]
-                ]).mean())
-                if replace_invalid_values_with_null and value < 0:
-                    value = None
-                yield Value(location=location, variable=variable,
-                            dimension_dict=dimension_dict, value=value)
+    for variable in variables:
+        dimension_value_ranges = []
+        for dimension in variable.dimensions:
+            dimension_value_ranges.append(range(dimension.size))
+        dimension_indices_combinations = list(itertools.product(
+            *dimension_value_ranges))
+        for dimension_indices_combination in tqdm(dimension_indices_combinations):
+            # one lat/lon plane per read, reduced to the location grid with
+            # blocks centred on every lat_count_reduced_by-th cell
+            location_values = coarsen(
+                dataset.variables[variable.name][dimension_indices_combination],
+                (lat_count_reduced_by, lon_count_reduced_by),
+                method=aggregation_method,
+                shape=(lat_count, lon_count),
+                offsets=(lat_count_reduced_by // 2, lon_count_reduced_by // 2)
+            ).ravel()
+            if replace_invalid_values_with_null:
+                location_values[location_values < 0] = np.nan
+            yield VariableArray(
+                variable=variable,
+                array=location_values,
+                location_ids=location_ids,
+                dimension_dict=dict(
+                    zip(variable.dimensions, dimension_indices_combination))
+            )
+
+
 values = values_generator()
 
 # %% main function
@@ -133,6 +131,6 @@ generate_gwfvis_db(db_path, Options(
     dimensions=dimensions,
     variables=variables,
     values=values
-))
+), WriterOptions(value_backend=value_backend))
 
 # %% finished
@@ -0,0 +1,169 @@
+# %% imports
+from typing import Dict, Iterator, Sequence, Tuple
+import numpy as np
+import shapefile
+from gwfvis_db import Location
+
+# %% data structures
+
+
+class ShapefileSource:
+    """A shapefile read as a stream of locations and value columns.
+
+    Nothing is materialised for the whole file: `iter_locations` builds one
+    `Location` per shape as it is consumed and `iter_record_columns` reads the
+    .dbf alone, in chunks of `chunk_size` records. Field positions are looked
+    up once; metadata holds every field unless `metadata_fields` or
+    `exclude_fields` say otherwise. With a `bbox`, shapes are selected on their .shp record headers
+    (see `get_shape_indices_in_bbox`) and only the selected shapes and records
+    are ever parsed.
+    """
+
+    def __init__(self, path: str, id_field: str, metadata_fields: Sequence[str] = None, exclude_fields: Sequence[str] = (),
+                 bbox: Sequence[float] = None, contained: bool = True):
+        self.path = path
+        self.reader = shapefile.Reader(path)
+        self.field_names = list(
+            map(lambda field: field[0], self.reader.fields[1:]))
+        self.id_field = id_field
+        self.metadata_fields = list(filter(lambda field_name: field_name not in exclude_fields,
+                                           metadata_fields if metadata_fields is not None else self.field_names))
+        self.bbox = bbox
+        self.contained = contained
+        self._id_index = self.field_names.index(id_field)
+        self._metadata_indices = list(
+            map(self.field_names.index, self.metadata_fields))
+        self._shape_indices = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.reader.close()
+
+    @property
+    def shape_indices(self) -> np.ndarray:
+        """Indices of the selected shapes, or None when there is no bbox."""
+        if self._shape_indices is None and self.bbox is not None:
+            self._shape_indices = get_shape_indices_in_bbox(
+                self.reader, self.bbox, self.contained)
+        return self._shape_indices
+
+    def _iter_shape_records(self):
+        if self.shape_indices is None:
+            return self.reader.iterShapeRecords()
+        return map(lambda index: self.reader.shapeRecord(int(index)), self.shape_indices)
+
+    def _iter_records(self):
+        if self.shape_indices is None:
+            return self.reader.iterRecords()
+        return map(lambda index: self.reader.record(int(index)), self.shape_indices)
+
+    def iter_locations(self) -> Iterator[Location]:
+        for shape_record in self._iter_shape_records():
+            record = shape_record.record
+            yield Location(
+                id=int(record[self._id_index]),
+                geometry=shape_record.shape.__geo_interface__,
+                metadata=dict(zip(self.metadata_fields, map(
+                    record.__getitem__, self._metadata_indices)))
+            )
+
+    def iter_record_columns(self, field_names: Sequence[str], chunk_size: int = 100000) -> Iterator[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+        """Yields `(location_ids, {field_name: values})` per chunk of records,
+        with the values as float arrays and empty fields as NaN."""
+        field_indices = list(map(self.field_names.index, field_names))
+        location_ids = []
+        rows = []
+
+        def to_columns():
+            columns = np.array(rows, dtype=float).reshape(
+                len(rows), len(field_names))
+            return np.asarray(location_ids, dtype=np.int64), dict(zip(field_names, columns.T))
+
+        for record in self._iter_records():
+            location_ids.append(int(record[self._id_index]))
+            rows.append(list(map(lambda index: np.nan if record[index] is None else record[index],
+                                 field_indices)))
+            if len(rows) >= chunk_size:
+                yield to_columns()
+                location_ids = []
+                rows = []
+        if len(rows) > 0:
+            yield to_columns()
+
+    def get_location_ids(self) -> np.ndarray:
+        """Ids of the selected locations, read from the .dbf alone."""
+        return np.concatenate([np.zeros(0, dtype=np.int64)] + list(map(
+            lambda chunk: chunk[0], self.iter_record_columns([]))))
+
+
+# %% helpers
+_NULL_SHAPE_TYPE = 0
+_POINT_SHAPE_TYPES = [shapefile.POINT, shapefile.POINTZ, shapefile.POINTM]
+_RECORD_HEADER_SIZE = 8
+# record header plus the shape type and four bbox doubles
+_SHAPE_PREFIX_SIZE = _RECORD_HEADER_SIZE + 4 + 32
+
+
+def _get_shape_offsets(reader: shapefile.Reader):
+    if reader.shx is not None:
+        reader.shx.seek(100)
+        # (offset, content length) pairs in 16-bit words, big-endian
+        return np.frombuffer(reader.shx.read(), dtype='>i4').reshape(-1, 2)[:, 0].astype(np.int64) * 2
+    # without an index the record headers are followed through the file
+    offsets = []
+    offset = 100
+    reader.shp.seek(0, 2)
+    file_size = reader.shp.tell()
+    while offset + _RECORD_HEADER_SIZE <= file_size:
+        reader.shp.seek(offset + 4)
+        content_length = int.from_bytes(reader.shp.read(4), 'big') * 2
+        offsets.append(offset)
+        offset += _RECORD_HEADER_SIZE + content_length
+    return np.asarray(offsets, dtype=np.int64)
+
+
+# %% exported functions
+
+def read_shape_bboxes(reader: shapefile.Reader) -> np.ndarray:
+    """Bounding boxes `(min_x, min_y, max_x, max_y)` of every shape, read from
+    the record headers of the .shp file without parsing any geometry. Null
+    shapes get NaN boxes."""
+    offsets = _get_shape_offsets(reader)
+    prefixes = bytearray(len(offsets) * _SHAPE_PREFIX_SIZE)
+    for i, offset in enumerate(offsets):
+        reader.shp.seek(offset)
+        prefix = reader.shp.read(_SHAPE_PREFIX_SIZE)
+        prefixes[i * _SHAPE_PREFIX_SIZE:i *
+                 _SHAPE_PREFIX_SIZE + len(prefix)] = prefix
+    prefixes = np.frombuffer(bytes(prefixes), dtype=np.uint8).reshape(
+        -1, _SHAPE_PREFIX_SIZE)
+    shape_types = prefixes[:, _RECORD_HEADER_SIZE:_RECORD_HEADER_SIZE + 4].copy().view('<i4')[:, 0]
+    bboxes = prefixes[:, _RECORD_HEADER_SIZE + 4:].copy().view('<f8')
+    is_point = np.isin(shape_types, _POINT_SHAPE_TYPES)
+    # a point record stores x and y where other shapes start their bbox
+    bboxes[is_point, 2:] = bboxes[is_point, :2]
+    bboxes[shape_types == _NULL_SHAPE_TYPE] = np.nan
+    return bboxes
+
+
+def get_shape_indices_in_bbox(reader: shapefile.Reader, bbox: Sequence[float], contained: bool = True) -> np.ndarray:
+    """Indices of the shapes whose bbox lies inside `bbox`, or intersects it
+    when `contained` is False. Only the record headers are read, so skipped
+    shapes never have their geometry or record built."""
+    bboxes = read_shape_bboxes(reader)
+    with np.errstate(invalid='ignore'):
+        if contained:
+            selected = (bboxes[:, 0] >= bbox[0]) & (bboxes[:, 1] >= bbox[1]) & \
+                (bboxes[:, 2] <= bbox[2]) & (bboxes[:, 3] <= bbox[3])
+        else:
+            selected = (bboxes[:, 2] >= bbox[0]) & (bboxes[:, 3] >= bbox[1]) & \
+                (bboxes[:, 0] <= bbox[2]) & (bboxes[:, 1] <= bbox[3])
+    return np.flatnonzero(selected)
+
+
+# %%
@@ -48,14 +48,15 @@ variables = [
 ]
 
 #%% values
-values: Sequence[Value] = []
-for i, station in enumerate(stations):
-    value = station['Most Recent Water Level (m)']
-    if value is not None and value != '':
-        values.append(Value(location=locations[i], variable=water_level_variable, value=float(value), dimension_dict={default_dimension: 0}))
-    value = station['Most Recent Discharge (m3/s)']
-    if value is not None and value != '':
-        values.append(Value(location=locations[i], variable=discharge_variable, value=float(value), dimension_dict={default_dimension: 0}))
+def values_generator():
+    for i, station in enumerate(stations):
+        value = station['Most Recent Water Level (m)']
+        if value is not None and value != '':
+            yield Value(location=locations[i], variable=water_level_variable, value=float(value), dimension_dict={default_dimension: 0})
+        value = station['Most Recent Discharge (m3/s)']
+        if value is not None and value != '':
+            yield Value(location=locations[i], variable=discharge_variable, value=float(value), dimension_dict={default_dimension: 0})
+values = values_generator()
 
 # %% main function
 generate_gwfvis_db(db_path, Options(
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from gwfvis_db import Dimension, GwfVisDB, Location, Options, Variable, VariableArray, VariableStorage, WriterOptions, export_gwfvis_db_arrays, generate_gwfvis_db, load_variable_arrays, read_gwfvis_db
+
+
+def _generate(path, array, writer_options=None, storage=None):
+    dimension_time = Dimension(id=0, name='time', size=array.shape[1])
+    variable = Variable(id=0, name='v', dimensions=[
+                        dimension_time], storage=storage)
+    locations = list(map(lambda location_id: Location(id=location_id, geometry={
+        'type': 'Point', 'coordinates': [location_id, 0]}), range(1, array.shape[0] + 1)))
+    generate_gwfvis_db(str(path), Options(info=[], locations=locations, dimensions=[dimension_time], variables=[variable], values=[
+        VariableArray(variable=variable, array=array, location_ids=list(range(1, array.shape[0] + 1)), dimensions=[dimension_time])]),
+        writer_options)
+    return str(path)
+
+
+def _get_value_cells(values):
+    return sorted(map(lambda value: (value.location.id, *value.dimension_dict.values(), value.value), values),
+                  key=lambda cell: cell[:-1])
+
+
+@pytest.mark.parametrize('value_backend', ['sqlite_chunks', 'npy_directory'])
+def test_chunked_backends_drop_null_cells(tmp_path, value_backend):
+    array = np.array([[1.0, np.nan], [2.0, 3.0]])
+    table_cells = _get_value_cells(read_gwfvis_db(
+        _generate(tmp_path / 'table.gwfvisdb', array)).values)
+    chunked_cells = _get_value_cells(read_gwfvis_db(_generate(
+        tmp_path / f'{value_backend}.gwfvisdb', array, WriterOptions(value_backend=value_backend))).values)
+    assert table_cells == [(1, 0, 1.0), (1, 1, None), (2, 0, 2.0), (2, 1, 3.0)]
+    assert chunked_cells == list(
+        filter(lambda cell: cell[-1] is not None, table_cells))
+    with GwfVisDB(str(tmp_path / 'table.gwfvisdb')) as table_db, GwfVisDB(str(tmp_path / f'{value_backend}.gwfvisdb')) as chunked_db:
+        assert np.array_equal(table_db.get_values_array(table_db.variables[0]), chunked_db.get_values_array(
+            chunked_db.variables[0]), equal_nan=True)
+
+
+def test_export_arrays_keeps_variable_storage(tmp_path):
+    storage = VariableStorage(dtype='int16', scale_factor=0.01)
+    array = np.array([[1.25, np.nan], [2.5, -3.75]])
+    path = _generate(tmp_path / 'packed.gwfvisdb', array, storage=storage)
+    export_gwfvis_db_arrays(path, str(tmp_path / 'arrays'))
+    variable_array = load_variable_arrays(str(tmp_path / 'arrays'))['v']
+    assert variable_array.variable.storage == storage
+    assert np.array_equal(variable_array.array, array, equal_nan=True)
+    rebuilt_path = str(tmp_path / 'rebuilt.gwfvisdb')
+    generate_gwfvis_db(rebuilt_path, Options(info=[], locations=read_gwfvis_db(path).locations, dimensions=variable_array.dimensions,
+                                             variables=[variable_array.variable], values=[variable_array]))
+    with GwfVisDB(rebuilt_path) as db:
+        assert db.variables[0].storage == storage
+        assert np.array_equal(db.get_values_array(
+            db.variables[0]), array, equal_nan=True)
+        stored_values = db.db_connection.execute(
+            'SELECT value FROM value WHERE value IS NOT NULL ORDER BY location, dimension_0').fetchall()
+    assert stored_values == [(125.0,), (250.0,), (-375.0,)]